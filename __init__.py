@@ -1,20 +1,35 @@
 from homeassistant.const import (EVENT_HOMEASSISTANT_STOP,
+                                 CONF_NAME,
                                  CONF_HOST,
                                  CONF_PORT,
                                  CONF_USERNAME,
                                  CONF_PASSWORD,
                                  CONF_DISCOVERY)
 
+from homeassistant.exceptions import HomeAssistantError
+from homeassistant.helpers.dispatcher import async_dispatcher_send
+from homeassistant.helpers.storage import Store
+
 from .gateway import Gateway
 from .light import vscpLight
 from .binary_sensor import vscpBinarySensor
 import homeassistant.helpers.config_validation as cv
-from .const import (DOMAIN, DEFAULT_HOST, DEFAULT_PORT, GATEWAY, SCANNER, SCANNER_TASK,
-                    SVC_PRIORITY, SVC_TYPE, SVC_CLASS, SVC_DATA)
+from .const import (DOMAIN, DEFAULT_HOST, DEFAULT_PORT, DEFAULT_COMMAND_CONNECTIONS,
+                    DEFAULT_MAX_READS, DEFAULT_MIN_STATE_INTERVAL, DEFAULT_METRICS, DEFAULT_SEND_WINDOW,
+                    DEFAULT_PROTOCOL, DEFAULT_TOPIC, DEFAULT_BACKGROUND_RATE,
+                    GATEWAY, SCANNER_TASK, STATE_INTERVAL, LIGHTS, DIAGNOSTICS_FILE,
+                    CONF_COMMAND_CONNECTIONS, CONF_MAX_READS, CONF_MIN_STATE_INTERVAL, CONF_METRICS,
+                    CONF_SEND_WINDOW, CONF_PROTOCOL, CONF_TOPIC, CONF_GATEWAY,
+                    CONF_BACKGROUND_RATE,
+                    STORAGE_KEY, STORAGE_VERSION, SIGNAL_NEW_CHANNELS,
+                    SVC_PRIORITY, SVC_TYPE, SVC_CLASS, SVC_DATA,
+                    SVC_LIGHTS, SVC_STATE, SVC_BRIGHTNESS)
 import voluptuous as vol
 from .channel import channel_reg
 import asyncio
+import json
 from .vscp.event import Event
+from .zones import compile_states, merge_states, ConflictError
 
 import logging
 
@@ -22,17 +37,42 @@ logger = logging.getLogger(__name__)
 
 """Support for VSCP in HASS."""
 
+def _unique_names(gateways):
+    """Several gateways need a distinct name each, it namespaces their entities"""
+    if len(gateways) > 1:
+        names = [gw.get(CONF_NAME) for gw in gateways]
+        if None in names or len(set(names)) != len(names):
+            raise vol.Invalid('every gateway needs a unique name when several are configured')
+    return gateways
+
+
+GATEWAY_SCHEMA = vol.Schema(
+    {
+        vol.Optional(CONF_NAME): cv.slug,
+        vol.Required(CONF_HOST): cv.string,
+        vol.Optional(CONF_PORT, default=DEFAULT_PORT): cv.port,
+        vol.Optional(CONF_USERNAME): cv.string,
+        vol.Optional(CONF_PASSWORD): cv.string,
+        vol.Optional(CONF_DISCOVERY, default=False): cv.boolean,
+        vol.Optional(CONF_COMMAND_CONNECTIONS, default=DEFAULT_COMMAND_CONNECTIONS):
+            vol.All(int, vol.Range(min=1, max=8)),
+        vol.Optional(CONF_MAX_READS, default=DEFAULT_MAX_READS):
+            vol.All(int, vol.Range(min=1, max=64)),
+        vol.Optional(CONF_MIN_STATE_INTERVAL, default=DEFAULT_MIN_STATE_INTERVAL):
+            vol.All(vol.Coerce(float), vol.Range(min=0, max=60)),
+        vol.Optional(CONF_METRICS, default=DEFAULT_METRICS): cv.boolean,
+        vol.Optional(CONF_SEND_WINDOW, default=DEFAULT_SEND_WINDOW):
+            vol.All(int, vol.Range(min=1, max=256)),
+        vol.Optional(CONF_PROTOCOL, default=DEFAULT_PROTOCOL): vol.In(['text', 'binary', 'mqtt']),
+        vol.Optional(CONF_TOPIC, default=DEFAULT_TOPIC): cv.string,
+        vol.Optional(CONF_BACKGROUND_RATE, default=DEFAULT_BACKGROUND_RATE):
+            vol.All(int, vol.Range(min=0, max=10000))
+    }
+)
+
 CONFIG_SCHEMA = vol.Schema(
     {
-        DOMAIN: vol.Schema(
-            {
-                vol.Required(CONF_HOST): cv.string,
-                vol.Optional(CONF_PORT, default=DEFAULT_PORT): cv.port,
-                vol.Optional(CONF_USERNAME): cv.string,
-                vol.Optional(CONF_PASSWORD): cv.string,
-                vol.Optional(CONF_DISCOVERY, default=False): cv.boolean
-            }
-        )
+        DOMAIN: vol.All(cv.ensure_list, [GATEWAY_SCHEMA], _unique_names)
     },
     extra=vol.ALLOW_EXTRA
 )
@@ -42,66 +82,182 @@ SERVICE_SCHEMA = vol.Schema(
         vol.Required(SVC_PRIORITY): int,
         vol.Required(SVC_CLASS): int,
         vol.Required(SVC_TYPE): int,
-        vol.Required(SVC_DATA): cv.string
+        vol.Required(SVC_DATA): cv.string,
+        vol.Optional(CONF_GATEWAY): cv.string
     }
 )
 
-async def async_do_discovery(hass, config, updater):
-    logger.info('Starting VSCP discovery for HASS nodes.')
-    conf = config.get(DOMAIN)
-    host = conf.get(CONF_HOST)
-    port = conf.get(CONF_PORT)
-    user = conf.get(CONF_USERNAME)
-    password = conf.get(CONF_PASSWORD)
+LIGHT_STATE_SCHEMA = vol.Any(
+    vol.All(cv.boolean, lambda on: {SVC_STATE: on}),
+    vol.Schema(
+        {
+            vol.Required(SVC_STATE): cv.boolean,
+            vol.Optional(SVC_BRIGHTNESS): vol.All(int, vol.Range(min=0, max=255))
+        }
+    )
+)
 
-    scanner = Gateway(host=host, port=port, user=user, password=password)
-    hass.data[DOMAIN][SCANNER] = scanner
-    await scanner.connect()
-    await scanner.scan(updater)
+SET_LIGHTS_SCHEMA = vol.Schema(
+    {
+        vol.Required(SVC_LIGHTS): {cv.entity_id: LIGHT_STATE_SCHEMA}
+    }
+)
 
-    hass.helpers.discovery.load_platform('light', DOMAIN, {}, config)
-    hass.helpers.discovery.load_platform('binary_sensor', DOMAIN, {}, config)
+def load_platforms(hass, config, gw):
+    info = {CONF_GATEWAY: gw.name}
+    hass.helpers.discovery.load_platform('light', DOMAIN, info, config)
+    hass.helpers.discovery.load_platform('binary_sensor', DOMAIN, info, config)
 
-    await scanner.close()
 
+async def async_do_discovery(hass, config, gw):
+    key = STORAGE_KEY if gw.name is None else '{}.{}'.format(STORAGE_KEY, gw.name)
+    store = Store(hass, STORAGE_VERSION, key)
+    cache = await store.async_load()
+    if cache:
+        # register the cached entities right away, the scan revalidates them
+        logger.info('Restoring {} VSCP nodes from the discovery cache.'.format(len(cache)))
+        gw.load_cache(cache)
+    # the platforms pick up the nodes known by then, later ones are streamed in
+    load_platforms(hass, config, gw)
 
-async def async_setup(hass, config):
-    """controller setup code"""
-    conf = config.get(DOMAIN)
-    host = conf.get(CONF_HOST)
-    port = conf.get(CONF_PORT)
-    user = conf.get(CONF_USERNAME)
-    password = conf.get(CONF_PASSWORD)
+    def node_done(created):
+        async_dispatcher_send(hass, SIGNAL_NEW_CHANNELS.format(gw.name), created)
+
+    await gw.wait_connected()
+    logger.info('Starting VSCP discovery for HASS nodes.')
+    await gw.scan(on_node=node_done)
+
+    await store.async_save(gw.to_cache())
 
-    hass.data[DOMAIN] = dict()
 
-    gw = Gateway(host=host, port=port, user=user, password=password)
-    await gw.connect()
-    await gw.start_update()
-    hass.data[DOMAIN][GATEWAY] = gw
+async def async_setup_gateway(hass, config, conf):
+    """Connect to one segment and start its discovery. A segment which can't
+       be connected is set up regardless, it keeps connecting in the
+       background and its entities are unavailable until it is connected."""
+    gw = Gateway(host=conf.get(CONF_HOST), port=conf.get(CONF_PORT),
+                 user=conf.get(CONF_USERNAME), password=conf.get(CONF_PASSWORD),
+                 command_connections=conf.get(CONF_COMMAND_CONNECTIONS),
+                 max_reads=conf.get(CONF_MAX_READS),
+                 metrics=conf.get(CONF_METRICS),
+                 window=conf.get(CONF_SEND_WINDOW),
+                 protocol=conf.get(CONF_PROTOCOL),
+                 topic=conf.get(CONF_TOPIC),
+                 name=conf.get(CONF_NAME),
+                 background_rate=conf.get(CONF_BACKGROUND_RATE))
+    try:
+        await gw.connect()
+        await gw.start_update()
+    except Exception as e:
+        logger.error('Failed to connect to the VSCP daemon {}:{} ({!r}), retrying in the background'.format(
+            conf.get(CONF_HOST), conf.get(CONF_PORT), e))
+        gw.supervise()
+    hass.data[DOMAIN][GATEWAY][gw.name] = gw
+    hass.data[DOMAIN][STATE_INTERVAL][gw.name] = conf.get(CONF_MIN_STATE_INTERVAL)
+
+    if conf.get(CONF_METRICS):
+        hass.helpers.discovery.load_platform('sensor', DOMAIN, {CONF_GATEWAY: gw.name}, config)
 
     if conf.get(CONF_DISCOVERY):
-        hass.data[DOMAIN][SCANNER_TASK] = asyncio.create_task(async_do_discovery(hass, config, gw))
+        hass.data[DOMAIN][SCANNER_TASK][gw.name] = asyncio.create_task(async_do_discovery(hass, config, gw))
+
+
+def _receivers(gw, lights):
+    """Return the addresses of the CONTROL receivers known on a segment and
+       the zones of which all receivers are known. Discovered light channels
+       count whether enabled or not. A zone is complete after a full scan
+       which found only VSCP4HASS nodes, unless a zone light (a receiver
+       which is not discovered) is configured in it."""
+    discovered = {ch.address for node in gw.nodes.values() for ch in node.all_channels()
+                  if isinstance(ch, vscpLight)}
+    configured = {light.address for light in lights.values()
+                  if light.gateway is gw and not isinstance(light, vscpLight)}
+    complete = set()
+    if gw.scan_complete and all(node.is_vscp4hass for node in gw.nodes.values()):
+        complete = {zone for (zone, _) in discovered} - {zone for (zone, _) in configured}
+    return (discovered | configured, complete)
+
+
+def _gateway(hass, name):
+    gateways = hass.data[DOMAIN][GATEWAY]
+    if name not in gateways:
+        raise HomeAssistantError('{} is not a configured VSCP gateway'.format(name))
+    return gateways[name]
+
+
+async def async_setup(hass, config):
+    """controller setup code"""
+    hass.data[DOMAIN] = dict()
+    hass.data[DOMAIN][GATEWAY] = dict()  # gateway name -> Gateway
+    hass.data[DOMAIN][STATE_INTERVAL] = dict()  # gateway name -> minimal state interval
+    hass.data[DOMAIN][SCANNER_TASK] = dict()  # gateway name -> discovery task
+    hass.data[DOMAIN][LIGHTS] = dict()
+    gateways = hass.data[DOMAIN][GATEWAY]
 
     async def on_hass_stop(event):
-        """Close connection when hass stops."""
-        await gw.close()
-        if SCANNER_TASK in hass.data[DOMAIN]:
-            task = hass.data[DOMAIN][SCANNER_TASK]
-            if task is not None:
-                try:
-                    task.cancel()
-                except asyncio.CancelledError:
-                    pass
+        """Close connections when hass stops."""
+        await asyncio.gather(*[gw.close() for gw in gateways.values()])
+        for task in hass.data[DOMAIN][SCANNER_TASK].values():
+            task.cancel()
+            try:
                 await task
+            except asyncio.CancelledError:
+                pass
     hass.bus.async_listen_once(EVENT_HOMEASSISTANT_STOP, on_hass_stop)
 
+    # every segment has its own connections, receive loop and dispatcher,
+    # one that can't be reached does not hold back the others
+    await asyncio.gather(*[async_setup_gateway(hass, config, conf) for conf in config.get(DOMAIN)])
+
     async def handle_send_event(call):
-        await gw.send(Event(vscp_class = call.data.get(SVC_CLASS),
-                            vscp_type = call.data.get(SVC_TYPE),
-                            head = call.data.get(SVC_PRIORITY)*32,
-                            data = bytearray([int(x,0) for x in call.data.get(SVC_DATA).split(',')])))
+        """Send an event on one segment, or on all of them without gateway"""
+        name = call.data.get(CONF_GATEWAY)
+        targets = gateways.values() if name is None else [_gateway(hass, name)]
+        event = Event(vscp_class = call.data.get(SVC_CLASS),
+                      vscp_type = call.data.get(SVC_TYPE),
+                      data = bytearray([int(x,0) for x in call.data.get(SVC_DATA).split(',')]))
+        await asyncio.gather(*[gw.send(event, confirm=True, priority=call.data.get(SVC_PRIORITY))
+                               for gw in targets])
 
     hass.services.async_register(DOMAIN, 'send_event', handle_send_event, SERVICE_SCHEMA)
 
+    async def handle_set_lights(call):
+        """Switch a number of lights in one batch, using zone/subzone wide
+           events where all lights of a zone or subzone get the same command.
+           Zones are local to a segment, every segment gets its own batch."""
+        lights = hass.data[DOMAIN][LIGHTS]
+        wanted = dict()  # gateway -> list of (address, on, level)
+        for entity_id, state in call.data.get(SVC_LIGHTS).items():
+            if entity_id not in lights:
+                raise HomeAssistantError('{} is not a VSCP light'.format(entity_id))
+            light = lights[entity_id]
+            level = state.get(SVC_BRIGHTNESS) if light.supports_level else None
+            wanted.setdefault(light.gateway, []).append((light.address, state[SVC_STATE], level))
+        batches = []
+        for gw, segment in wanted.items():
+            try:
+                states = merge_states(segment)
+            except ConflictError as e:
+                raise HomeAssistantError(str(e))
+            (known, complete) = _receivers(gw, lights)
+            events = compile_states(states, known, complete)
+            logger.debug('Setting {} lights with {} events'.format(len(segment), len(events)))
+            batches.append(gw.send_many(events, confirm=True))
+        await asyncio.gather(*batches)
+
+    hass.services.async_register(DOMAIN, 'set_lights', handle_set_lights, SET_LIGHTS_SCHEMA)
+
+    async def handle_dump_diagnostics(call):
+        """Write the state and metrics of all gateways to a JSON file in the config folder"""
+        path = hass.config.path(DIAGNOSTICS_FILE)
+        dump = json.dumps([gw.diagnostics() for gw in gateways.values()], indent=2, default=str)
+
+        def write():
+            with open(path, 'w') as f:
+                f.write(dump)
+
+        await hass.async_add_executor_job(write)
+        logger.info('VSCP diagnostics written to {}'.format(path))
+
+    hass.services.async_register(DOMAIN, 'dump_diagnostics', handle_dump_diagnostics)
+
     return True
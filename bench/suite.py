@@ -0,0 +1,290 @@
+"""Microbenchmarks for the VSCP protocol hot paths.
+
+Run from the repository root:
+    python bench/suite.py            compare against bench/baseline.json
+    python bench/suite.py --save     store the results as the new baseline
+
+Every benchmark reports operations per second (best of a few rounds).
+Benchmarks needing a package which is not installed are skipped.
+Results are compared relative to the reference benchmark, plain Python
+work not using the package, so a baseline stored on one machine holds on
+another which is faster or slower overall. The run fails (exit code 1)
+when a benchmark drops more than --threshold below its baseline."""
+import argparse
+import asyncio
+import json
+import os
+import struct
+import sys
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..'))
+
+from vscp.const import CLASS_INFORMATION, CLASS_VSCP, EVENT_EXT_PAGE_RESP  # noqa: E402
+from vscp.dispatch import Dispatcher, ANY  # noqa: E402
+from vscp.event import Event  # noqa: E402
+from vscp.filter import Filter  # noqa: E402
+from vscp.guid import Guid  # noqa: E402
+from vscp.register import RegisterReader  # noqa: E402
+
+BASELINE = os.path.join(BENCH_DIR, 'baseline.json')
+RECORDED = os.path.join(BENCH_DIR, 'data', 'uvscpd_stream.txt')
+
+# benchmark the others are compared relative to
+REFERENCE = 'reference'
+
+benchmarks = dict()
+
+
+def benchmark(name):
+    """Register a benchmark. The decorated function returns a callable
+       and the number of operations one call of it performs. A coroutine
+       function is run on an event loop of its own."""
+    def register(func):
+        benchmarks[name] = func
+        return func
+    return register
+
+
+def _recorded_lines():
+    with open(RECORDED) as f:
+        return [line for line in f if line.strip()]
+
+
+def _synthetic_lines(count=1000):
+    lines = []
+    for i in range(count):
+        nickname = i % 128
+        guid = ':'.join(['FF'] * 15 + ['%02X' % nickname])
+        lines.append('96,20,{},0,2020-11-21T18:42:{:02d}Z,{},{},{},{},{}\r\n'.format(
+            3 + i % 2, (i // 50) % 60, i * 1000, guid, i % 16, i % 4, i % 8))
+    return lines
+
+
+def _guid(nickname):
+    return Guid(bytes(15) + bytes([nickname]))
+
+
+@benchmark(REFERENCE)
+def reference():
+    """Split and convert the recorded lines with builtins only"""
+    lines = _recorded_lines()
+    return (lambda: [[int(field) if field.isdigit() else field for field in line.split(',')]
+                     for line in lines]), len(lines)
+
+
+@benchmark('parse_recorded')
+def parse_recorded():
+    lines = _recorded_lines()
+    return (lambda: [Event.from_string(line) for line in lines]), len(lines)
+
+
+@benchmark('parse_generic')
+def parse_generic():
+    """The generic parser on the recorded lines, the reference for the fast path"""
+    import dateutil.parser  # noqa: F401, raises ImportError without python-dateutil
+    lines = _recorded_lines()
+    return (lambda: [Event._from_string_generic(line) for line in lines]), len(lines)
+
+
+@benchmark('parse_synthetic')
+def parse_synthetic():
+    lines = _synthetic_lines()
+    return (lambda: [Event.from_string(line) for line in lines]), len(lines)
+
+
+@benchmark('encode_event')
+def encode_event():
+    events = [Event(vscp_class=30, vscp_type=5, data=bytes([0, i % 4, i % 8])) for i in range(1000)]
+
+    def run():
+        for event in events:
+            event._encoded = None  # measure the encoding, not the cache
+            event.encode()
+    return run, len(events)
+
+
+@benchmark('repr_event')
+def repr_event():
+    events = [Event.from_string(line) for line in _recorded_lines()]
+    return (lambda: [repr(event) for event in events]), len(events)
+
+
+@benchmark('guid_from_string')
+def guid_from_string():
+    strings = [':'.join(['%02X' % ((i * 7 + j) & 0xFF) for j in range(16)]) for i in range(1000)]
+
+    def run():
+        Guid._by_str.clear()  # measure decoding, not the intern table
+        for text in strings:
+            Guid.from_string(text)
+    return run, len(strings)
+
+
+@benchmark('filter_strings')
+def filter_strings():
+    filters = [Filter(0, 0, 20, 0x3ff, i % 256, 0xff, _guid(i % 128), _guid(0xff)) for i in range(1000)]
+    return (lambda: [(f.filter_str(), f.filter_mask_str()) for f in filters]), len(filters)
+
+
+def _dispatch(subscriptions):
+    dispatcher = Dispatcher()
+
+    async def callback(event):
+        pass
+
+    for i in range(subscriptions):
+        dispatcher.subscribe_channel(i % 128, (i // 128) % 256, CLASS_INFORMATION, 3 + (i // 32768) % 2, callback)
+    for i in range(subscriptions // 10):
+        dispatcher.subscribe_zone(i % 256, ANY, CLASS_INFORMATION, 3, callback)
+
+    events = [Event(CLASS_INFORMATION, 3 + i % 2, bytes([i % 256, i % 256, i % 8]), guid=_guid(i % 128))
+              for i in range(1000)]
+
+    async def run():
+        await dispatcher.dispatch_batch(events)
+    return run, len(events)
+
+
+@benchmark('dispatch_10')
+def dispatch_10():
+    return _dispatch(10)
+
+
+@benchmark('dispatch_1000')
+def dispatch_1000():
+    return _dispatch(1000)
+
+
+@benchmark('dispatch_10000')
+def dispatch_10000():
+    return _dispatch(10000)
+
+
+class _LoopbackBus:
+    """Answers EXT_PAGE_READ requests at once from a fixed register map"""
+    def __init__(self):
+        self.reader = RegisterReader(self)
+        self.registers = bytes(range(256))
+        self.guid = _guid(1)
+
+    async def send(self, event):
+        (nickname, page, reg, num) = struct.unpack('>BHBB', event.data)
+        num = num or 256
+        for index, offset in enumerate(range(0, num, 4)):
+            start = (reg + offset) & 0xFF
+            payload = self.registers[start:start + min(4, num - offset)]
+            self.reader.process_event(Event(CLASS_VSCP, EVENT_EXT_PAGE_RESP,
+                                            struct.pack('>BHB', index, page, start) + payload,
+                                            guid=self.guid))
+
+
+@benchmark('read_reg_34')
+def read_reg_34():
+    bus = _LoopbackBus()
+
+    async def reads():
+        for page in range(100):
+            await bus.reader.read(1, page, 0, 34)
+
+    return reads, 100
+
+
+def measure(setup, min_time=0.2, rounds=3):
+    """Return the best operations per second over a few rounds"""
+    (run, ops) = setup()
+    if asyncio.iscoroutinefunction(run):
+        loop = asyncio.new_event_loop()
+        try:
+            return _measure(lambda: loop.run_until_complete(run()), ops, min_time, rounds)
+        finally:
+            loop.close()
+    return _measure(run, ops, min_time, rounds)
+
+
+def _measure(run, ops, min_time, rounds):
+    run()  # warm up
+    best = 0
+    for _ in range(rounds):
+        count = 0
+        start = time.perf_counter()
+        while True:
+            run()
+            count += ops
+            elapsed = time.perf_counter() - start
+            if elapsed >= min_time:
+                break
+        best = max(best, count / elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--save', action='store_true', help='store the results as baseline')
+    parser.add_argument('--baseline', default=BASELINE)
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help='allowed relative drop below the baseline, relative to the '
+                             'reference benchmark (default 0.25)')
+    parser.add_argument('--min-time', type=float, default=0.2, help='seconds per round')
+    parser.add_argument('names', nargs='*', help='benchmarks to run (default all)')
+    args = parser.parse_args()
+
+    baseline = dict()
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    names = args.names or list(benchmarks)
+    if REFERENCE in names:
+        names.remove(REFERENCE)
+    results = dict()
+    skipped = dict()
+    # the reference is measured first and last, the best of both is less
+    # exposed to a slow moment of the machine than a single measurement
+    reference = measure(benchmarks[REFERENCE], min_time=args.min_time)
+    for name in names:
+        try:
+            results[name] = round(measure(benchmarks[name], min_time=args.min_time))
+        except ImportError as e:
+            skipped[name] = e
+    reference = max(reference, measure(benchmarks[REFERENCE], min_time=args.min_time))
+    results[REFERENCE] = round(reference)
+
+    failed = []
+    for name in [REFERENCE] + names:
+        if name in skipped:
+            print('{:<20} skipped ({})'.format(name, skipped[name]))
+            continue
+        line = '{:<20} {:>12.0f} ops/s'.format(name, results[name])
+        if name != REFERENCE and name in baseline and REFERENCE in baseline:
+            # machine speed cancels out in the ratio to the reference
+            change = (results[name] / reference) / (baseline[name] / baseline[REFERENCE]) - 1
+            line += '  {:>+7.1%} vs baseline'.format(change)
+            if change < -args.threshold:
+                line += '  REGRESSION'
+                failed.append(name)
+        print(line)
+
+    if args.save:
+        if not args.names:
+            baseline = dict()  # a full run replaces the baseline, reference included
+        elif REFERENCE in baseline:
+            # keep the stored benchmarks relative to the stored reference
+            scale = baseline[REFERENCE] / results[REFERENCE]
+            results = {name: round(ops * scale) for (name, ops) in results.items()}
+        baseline.update(results)
+        with open(args.baseline, 'w') as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+            f.write('\n')
+        print('baseline stored in {}'.format(args.baseline))
+        return 0
+
+    if failed:
+        print('regressions: {}'.format(', '.join(failed)))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
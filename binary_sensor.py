@@ -1,13 +1,15 @@
 import logging
 
 from .channel import Channel
-from .const import DOMAIN, SCANNER
+from .throttle import StateWriter
+from .const import DOMAIN, GATEWAY, STATE_INTERVAL, CONF_GATEWAY, SIGNAL_NEW_CHANNELS
 
 from .vscp.const import (CLASS_INFORMATION, EVENT_INFORMATION_ON, EVENT_INFORMATION_OFF)
-from .vscp.util import read_reg
 
 from homeassistant.components.binary_sensor import (BinarySensorEntity)
 from homeassistant.const import STATE_OFF, STATE_ON
+from homeassistant.core import callback
+from homeassistant.helpers.dispatcher import async_dispatcher_connect
 
 _LOGGER = logging.getLogger(__name__)
 
@@ -19,31 +21,54 @@ async def async_setup_platform(hass, config, async_add_entities, discovery_info=
         #to do, add entries from configuration.yaml here
         return
     else:
-        for node in hass.data[DOMAIN][SCANNER].nodes.values():
-            async_add_entities([ch for ch in node.get_channels(IDENTIFIER) if ch.enabled])
+        gw = hass.data[DOMAIN][GATEWAY][discovery_info[CONF_GATEWAY]]
+        added = set()  # unique ids, a node read while loading may be signalled as well
+
+        @callback
+        def async_add_channels(channels):
+            """Add channels found after the platform was loaded"""
+            new = [ch for ch in channels if isinstance(ch, vscpBinarySensor) and ch.enabled and ch.unique_id not in added]
+            added.update(ch.unique_id for ch in new)
+            async_add_entities(new)
+
+        for node in gw.nodes.values():
+            async_add_channels(node.get_channels(IDENTIFIER))
+
+        async_dispatcher_connect(hass, SIGNAL_NEW_CHANNELS.format(gw.name), async_add_channels)
     return True
 
 class vscpBinarySensor(BinarySensorEntity, Channel):
     """Representation of an VSCP binary sensor."""
+    STATE_REGISTERS = (0x04,)
+
     @classmethod
-    async def new(cls, node, channel):
-        self = cls()
-        self._node = node
-        self._channel = channel
+    def from_registers(cls, node, channel, registers):
+        self = super().from_registers(node, channel, registers)
+        # only set once, the entity registry or the user may change it later
+        self.entity_id = "binary_sensor.vscp.{}{}.{}".format(node.updater.namespace, node.guid, channel)
+        return self
 
-        registers = await read_reg(node.bus, node.nickname, channel, 0, 34)
+    def apply_registers(self, registers):
+        self.registers = bytes(registers)
         self._enabled = (registers[0x03] != 0x00)
         self._state = (registers[0x04] != 0x00)
         self._class_id = int(registers[0x05])
         self._name = registers[16:33].decode().rstrip('/x0')
-        self.entity_id = "binary_sensor.vscp.{}.{}".format(self._node.guid, self._channel)
-
-        return self
 
     async def async_added_to_hass(self):
         await super().async_added_to_hass()
-        await self._node.updater.sub_ch_event(self._node.nickname, self._channel, CLASS_INFORMATION, EVENT_INFORMATION_ON, self._handle_onoff_event)
-        await self._node.updater.sub_ch_event(self._node.nickname, self._channel, CLASS_INFORMATION, EVENT_INFORMATION_OFF, self._handle_onoff_event)
+        self._state_writer = StateWriter(self, self.hass.data[DOMAIN][STATE_INTERVAL][self._node.updater.name],
+                                         self._node.updater.metrics)
+        self._subscriptions = [
+            await self._node.updater.sub_ch_event(self._node.nickname, self._channel, CLASS_INFORMATION, EVENT_INFORMATION_ON, self._handle_onoff_event),
+            await self._node.updater.sub_ch_event(self._node.nickname, self._channel, CLASS_INFORMATION, EVENT_INFORMATION_OFF, self._handle_onoff_event)]
+        self._node.updater.add_state_listener(self.async_write_ha_state)
+
+    async def async_will_remove_from_hass(self):
+        for subscription in self._subscriptions:
+            subscription.unsubscribe()
+        self._node.updater.remove_state_listener(self.async_write_ha_state)
+        self._state_writer.cancel()
 
     @property
     def is_on(self):
@@ -63,14 +88,14 @@ class vscpBinarySensor(BinarySensorEntity, Channel):
         """Return the display name of this light."""
         return self._name
 
-    # when a node goes offline, we can disable it's channels
+    # unavailable while the daemon is unreachable or the node did not answer the scan or resync
     @property
     def available(self):
-        return True
+        return self._node.updater.connected and self._node.available
 
     @property
     def unique_id(self):
-        return "BS-{}-{}".format(self._node.guid, self._channel)
+        return "BS-{}{}-{}".format(self._node.updater.namespace, self._node.guid, self._channel)
 
     @property
     def should_poll(self):
@@ -78,7 +103,7 @@ class vscpBinarySensor(BinarySensorEntity, Channel):
 
     async def _handle_onoff_event(self, event):
         self._state = (event.vscp_type == EVENT_INFORMATION_ON)
-        self.async_schedule_update_ha_state()
+        self._state_writer.schedule(event)
 
     @property
     def device_class(self):
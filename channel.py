@@ -1,5 +1,8 @@
 channel_reg = {}
 
+# number of registers read for every channel
+BLOCK_SIZE = 34
+
 
 class DuplicateIdentifierError(Exception):
     pass
@@ -7,9 +10,56 @@ class DuplicateIdentifierError(Exception):
 
 class Channel:
     """Base class for all channel classes to derive from"""
+    # offsets of registers holding state instead of configuration
+    STATE_REGISTERS = ()
+
     def __init_subclass__(cls, **kwargs):
         super().__init_subclass__(**kwargs)
         # todo: check if cls.identifier exist, handle exception accordingly
         if cls.identifier() in channel_reg:
             raise DuplicateIdentifierError()
         channel_reg[cls.identifier()] = cls
+
+    @classmethod
+    def from_registers(cls, node, channel, registers):
+        """Build a channel from a register block, without bus traffic"""
+        self = cls()
+        self._node = node
+        self._channel = channel
+        self.apply_registers(registers)
+        return self
+
+    def apply_registers(self, registers):
+        """Take over configuration and state from a register block"""
+        raise NotImplementedError
+
+    def update_registers(self, registers):
+        """Apply a freshly read register block and push the new state"""
+        self.apply_registers(registers)
+        if self.hass is not None:
+            self.async_schedule_update_ha_state()
+
+    def update_state(self, values):
+        """Apply freshly read state registers, values starts at the first
+           offset of STATE_REGISTERS"""
+        (first, _) = self.state_span()
+        registers = bytearray(self.registers)
+        registers[first:first + len(values)] = values
+        self.update_registers(registers)
+
+    @classmethod
+    def state_span(cls):
+        """Return (first register, count) covering all state registers"""
+        return (min(cls.STATE_REGISTERS), max(cls.STATE_REGISTERS) - min(cls.STATE_REGISTERS) + 1)
+
+    @property
+    def index(self):
+        return self._channel
+
+    @classmethod
+    def config_bytes(cls, registers):
+        """Return the configuration part of a register block"""
+        config = bytearray(registers)
+        for offset in cls.STATE_REGISTERS:
+            config[offset] = 0
+        return bytes(config)
@@ -3,13 +3,43 @@ DOMAIN = 'vscp'
 DEFAULT_HOST = '127.0.0.1'
 DEFAULT_PORT = 8598
 
+DEFAULT_COMMAND_CONNECTIONS = 1
+DEFAULT_MAX_READS = 4
+DEFAULT_MIN_STATE_INTERVAL = 0.2
+DEFAULT_METRICS = False
+DEFAULT_SEND_WINDOW = 32
+DEFAULT_PROTOCOL = 'text'
+DEFAULT_TOPIC = 'vscp'
+DEFAULT_BACKGROUND_RATE = 200
+
 GATEWAY = 'gateway'
 SCANNER_TASK = 'scanner_task'
-SCANNER = 'scanner'
+STATE_INTERVAL = 'state_interval'
+LIGHTS = 'lights'
+
+STORAGE_KEY = 'vscp.discovery'
+STORAGE_VERSION = 1
+
+# formatted with the gateway name, every segment has its own signal
+SIGNAL_NEW_CHANNELS = 'vscp_new_channels_{}'
 
 CONF_SUBZONE = 'subzone'
+CONF_GATEWAY = 'gateway'
+CONF_COMMAND_CONNECTIONS = 'command_connections'
+CONF_MAX_READS = 'max_reads'
+CONF_MIN_STATE_INTERVAL = 'min_state_interval'
+CONF_METRICS = 'metrics'
+CONF_SEND_WINDOW = 'send_window'
+CONF_PROTOCOL = 'protocol'
+CONF_TOPIC = 'topic'
+CONF_BACKGROUND_RATE = 'background_rate'
+
+DIAGNOSTICS_FILE = 'vscp_diagnostics.json'
 
 SVC_PRIORITY = 'priority'
 SVC_TYPE = 'type'
 SVC_CLASS = 'class'
-SVC_DATA = 'data'
\ No newline at end of file
+SVC_DATA = 'data'
+SVC_LIGHTS = 'lights'
+SVC_STATE = 'state'
+SVC_BRIGHTNESS = 'brightness'
\ No newline at end of file
@@ -1,64 +1,368 @@
-from homeassistant.const import EVENT_HOMEASSISTANT_STOP
-from .vscp.util import who_is_there
-from .vscp.tcp import TCP
-from .vscp.filter import Filter
+import asyncio
+import logging
+from .vscp.util import who_is_there_all
+from .vscp.tcp import TCP, DEF_WINDOW
+from .vscp.binary import BinaryTCP
+from .vscp.mqtt import MQTT, DEF_PREFIX
+from .vscp.guid import Guid
+from .vscp.const import CLASS_VSCP
+from .vscp.dispatch import Dispatcher, ANY
+from .vscp.metrics import Metrics
+from .vscp.scheduler import Scheduler, INTERACTIVE, DISCOVERY, PRIORITY, DEF_RATE
 from .node import Node
 
+logger = logging.getLogger(__name__)
 
-class DuplicateEvent(Exception):
-    pass
+# reconnect backoff, doubled after every failed attempt
+RECONNECT_MIN_DELAY = 0.5
+RECONNECT_MAX_DELAY = 30
+CONNECT_TIMEOUT = 10
 
+# wire formats of the daemon connection
+TRANSPORTS = {'text': TCP, 'binary': BinaryTCP, 'mqtt': MQTT}
 
-class Gateway(TCP):
-    """This class connects to the SWALI VSCP Gateway."""
-    def __init__(self, *args, **kwargs):
-        """Initialize a Gateway object"""
-        super().__init__(*args, **kwargs)
+
+class Gateway:
+    """This class connects to the SWALI VSCP Gateway.
+
+    The gateway keeps a small pool of connections to the daemon:
+    - one event connection, always in RCVLOOP, which feeds the entities
+    - one or more command connections for request/response traffic
+      (who's there, register reads and writes)
+    so discovery and configuration reads never pause live events.
+
+    The connections are supervised: when one of them drops, all of them are
+    reconnected with exponential backoff, the daemon filter and receive loops
+    are restored and the state registers of all channels are read again.
+
+    Outbound traffic passes the scheduler: user commands go out at once with
+    a high VSCP priority, register reads of resync and discovery are rate
+    limited and yield to them (see vscp.scheduler)."""
+    def __init__(self, host, port, user=None, password=None, command_connections=1,
+                 max_reads=4, metrics=False, window=DEF_WINDOW, protocol='text', topic=DEF_PREFIX,
+                 name=None, background_rate=DEF_RATE):
+        """Initialize a Gateway object, metrics enables runtime metrics,
+           window is the number of commands in flight per connection and
+           protocol selects the transport (a key of TRANSPORTS). topic is the
+           topic prefix of the events when connecting to an MQTT broker.
+           name identifies the segment when several gateways are used.
+           background_rate limits the register reads per second, 0 disables."""
+        self.name = name
+        self._label = name or '{}:{}'.format(host, port)  # for log messages
+        self.metrics = Metrics() if metrics else None
+        self.protocol = protocol
+        self.scheduler = Scheduler(rate=background_rate, max_inflight=max_reads, metrics=self.metrics)
+        transport = TRANSPORTS[protocol]
+        options = dict()
+        if transport is MQTT:
+            # random client ids named after the gateway, unique on a shared broker
+            options = {'prefix': topic, 'client_name': 'vscp4hass' if name is None else 'vscp4hass-' + name}
+        self._events = transport(host=host, port=port, user=user, password=password, metrics=self.metrics,
+                                 on_lost=self._connection_lost, window=window, **options)
+        self._commands = [transport(host=host, port=port, user=user, password=password, metrics=self.metrics,
+                                    on_lost=self._connection_lost, window=window, **options)
+                          for _ in range(max(command_connections, 1))]
+        # every command connection sees all responses, one of them keeps the shadow registers current
+        self._commands[0].add_listener(self._register_event)
 
         self.nodes = dict() # list of nodes
         self.ch = dict() # list of channels for each channel class
-        self._channel_events = dict() # event sensitivity list, key = event type+guid+index, value = list of callbacks to call
-        self._zone_events = dict()
+        self.dispatcher = Dispatcher(on_change=self._subscriptions_changed)
+        self._filter = None  # (filter, mask) strings installed on the event connection
+        self._filter_pending = False
+        self._filter_task = None  # the running filter update
+        self.connected = False
+        self.reconnects = 0
+        self.scan_complete = False  # the last scan read every node which answered
+        self._state_listeners = []
+        self._reconnect_task = None
+        self._receiving = asyncio.Event()  # set while the event connection is in its receive loop
+        self._closing = False
+
+    @property
+    def namespace(self):
+        """Prefix of the identifiers of the entities on this segment"""
+        return '' if self.name is None else self.name + '-'
+
+    def command_connection(self, nickname=0):
+        """Return the command connection serving a node"""
+        return self._commands[nickname % len(self._commands)]
+
+    async def connect(self):
+        """Connect all connections, command connections only pass protocol events"""
+        await self._events.connect()
+        for conn in self._commands:
+            await conn.connect()
+            await conn.subscribe({(CLASS_VSCP, ANY, ANY)})
+            await conn.clrall()
+            await conn.rcvloop()
+        self.connected = True
+
+    async def close(self):
+        self._closing = True
+        if self._reconnect_task is not None:
+            self._reconnect_task.cancel()
+        if self._filter_task is not None:
+            self._filter_task.cancel()
+        await self._events.close()
+        for conn in self._commands:
+            await conn.close()
+
+    def add_state_listener(self, listener):
+        """Call listener() whenever the connection or node availability changes"""
+        self._state_listeners.append(listener)
+
+    def remove_state_listener(self, listener):
+        self._state_listeners.remove(listener)
+
+    def _notify_state(self):
+        for listener in list(self._state_listeners):
+            try:
+                listener()
+            except Exception:
+                logger.exception('Unhandled exception in state listener')
+
+    def _connection_lost(self):
+        """A connection dropped, start reconnecting all of them"""
+        if self._closing or self._reconnect_task is not None:
+            return
+        logger.warning('Connection to the VSCP daemon {} lost, reconnecting'.format(self._label))
+        self.connected = False
+        self._receiving.clear()
+        self._notify_state()
+        self._reconnect_task = asyncio.ensure_future(self._reconnect())
+
+    def supervise(self):
+        """Keep connecting in the background with backoff, after the first
+           connect failed"""
+        if self._closing or self._reconnect_task is not None:
+            return
+        self.connected = False
+        self._receiving.clear()
+        self._reconnect_task = asyncio.ensure_future(self._reconnect())
+
+    async def wait_connected(self):
+        """Wait until the gateway is connected and receiving events"""
+        await self._receiving.wait()
+
+    async def _reconnect(self):
+        delay = RECONNECT_MIN_DELAY
+        while True:
+            for conn in [self._events] + self._commands:
+                conn.abort()
+            for node in self.nodes.values():
+                node.registers.invalidate()  # registers may have changed while disconnected
+            self._filter = None
+            await asyncio.sleep(delay)
+            try:
+                await asyncio.wait_for(self.connect(), CONNECT_TIMEOUT)
+                await self._start_receiving()
+                break
+            except Exception as e:
+                self.connected = False
+                delay = min(delay * 2, RECONNECT_MAX_DELAY)
+                logger.warning('Reconnecting to the VSCP daemon {} failed ({!r}), retrying in {}s'.format(
+                    self._label, e, delay))
+        self._reconnect_task = None
+        self.reconnects += 1
+        logger.info('Reconnected to the VSCP daemon {}'.format(self._label))
+        self._notify_state()
+        await self.resync()
+
+    async def resync(self):
+        """Read the state registers of all known channels again"""
+        nodes = [node for node in self.nodes.values() if node.is_vscp4hass]
+        results = await asyncio.gather(*[node.resync() for node in nodes], return_exceptions=True)
+        for node, result in zip(nodes, results):
+            if isinstance(result, Exception):
+                logger.warning('Failed to resync node {}: {!r}'.format(node.nickname, result))
+        self._notify_state()
+
+    @property
+    def outbox_depth(self):
+        """Events waiting to be written, over all connections"""
+        return self._events.outbox_depth + sum(conn.outbox_depth for conn in self._commands)
+
+    def diagnostics(self):
+        """Return a JSON serializable snapshot of the gateway state"""
+        return {'name': self.name,
+                'nodes': {nickname: {'guid': str(node.guid),
+                                     'mdf': node.mdf,
+                                     'vscp4hass': node.is_vscp4hass,
+                                     'channels': len(node.all_channels()),
+                                     'registers': node.registers.as_dict()}
+                          for nickname, node in self.nodes.items()},
+                'subscriptions': {'channel': len(self.dispatcher.channel_keys()),
+                                  'zone': len(self.dispatcher.zone_keys())},
+                'filter': self._filter,
+                'scan_complete': self.scan_complete,
+                'connected': self.connected,
+                'reconnects': self.reconnects,
+                'outbox_depth': self.outbox_depth,
+                'scheduler': self.scheduler.as_dict(),
+                'metrics': self.metrics.as_dict() if self.metrics is not None else None}
+
+    def priority(self, traffic=INTERACTIVE):
+        """VSCP priority (0-7) of the events of a traffic class"""
+        return PRIORITY[traffic]
+
+    async def send(self, event, confirm=False, traffic=INTERACTIVE, priority=None):
+        """Send an event, protocol events go out over a command connection.
+           With confirm set, wait until the daemon accepted the event. The
+           VSCP priority defaults to the one of the traffic class."""
+        event = event.with_priority(PRIORITY[traffic] if priority is None else priority)
+        async with self.scheduler.slot(traffic):
+            if event.vscp_class == CLASS_VSCP:
+                return await self.command_connection().send(event, confirm)
+            return await self._events.send(event, confirm)
+
+    async def send_many(self, events, confirm=False, traffic=INTERACTIVE):
+        """Send a batch of events, coalesced per connection"""
+        events = [ev.with_priority(PRIORITY[traffic]) for ev in events]
+        protocol = [ev for ev in events if ev.vscp_class == CLASS_VSCP]
+        other = [ev for ev in events if ev.vscp_class != CLASS_VSCP]
+        sends = []
+        if protocol:
+            sends.append(self.command_connection().send_many(protocol, confirm))
+        if other:
+            sends.append(self._events.send_many(other, confirm))
+        async with self.scheduler.slot(traffic):
+            await asyncio.gather(*sends)
+
+    def _register_event(self, event):
+        """Keep the shadow registers of a node up to date with its register
+           responses, including the confirmations of writes"""
+        node = self.nodes.get(event.guid.nickname)
+        if node is not None:
+            node.registers.process_event(event)
+
+    async def read_registers(self, nickname, page, reg, num=1, priority=None, traffic=DISCOVERY):
+        """Read registers, scheduled in the traffic class. The VSCP priority
+           defaults to the one of the traffic class."""
+        if priority is None:
+            priority = PRIORITY[traffic]
+        async with self.scheduler.slot(traffic):
+            return await self.command_connection(nickname).read_registers(nickname, page, reg, num, priority)
 
     async def sub_ch_event(self, nickname, index, vscp_class, vscp_type, callback):
-        key = (nickname, index, vscp_class, vscp_type)
-        if key in self._channel_events:
-            raise DuplicateEvent
-        self._channel_events[key] = callback
+        """Subscribe to events of a node channel, returns a Subscription.
+           vscp_class and vscp_type can be ANY."""
+        return self.dispatcher.subscribe_channel(nickname, index, vscp_class, vscp_type, callback)
 
     async def sub_zone_event(self, vscp_class, vscp_type, vscp_zone, vscp_subzone, callback):
-        key = (vscp_zone, vscp_subzone, vscp_class, vscp_type)
-        if key in self._zone_events:
-            raise DuplicateEvent
-        self._zone_events[key] = callback
-
-    async def _process_event(self, event):
-        if len(event.data) > 0:
-            ch_key = (event.guid.nickname, event.data[0], event.vscp_class, event.vscp_type)
-            if ch_key in self._channel_events:
-                await self._channel_events[ch_key](event)  # do the callback
-
-        if len(event.data) >= 2:
-            print('got event!')
-            zone_key = (event.data[1], event.data[2], event.vscp_class, event.vscp_type)
-            if zone_key in self._zone_events:
-                await self._zone_events[zone_key](event)  # do the callback
+        """Subscribe to events for a zone/subzone, returns a Subscription.
+           All fields can be ANY."""
+        return self.dispatcher.subscribe_zone(vscp_zone, vscp_subzone, vscp_class, vscp_type, callback)
+
+    async def _process_events(self, events):
+        await self.dispatcher.dispatch_batch(events)
+
+    def _subscriptions_changed(self):
+        """Recompute the daemon filter once subscriptions settle (next loop iteration)"""
+        if not self._filter_pending:
+            self._filter_pending = True
+            asyncio.get_running_loop().call_soon(self._start_filter_update)
+
+    def _start_filter_update(self):
+        if self._closing:
+            return
+        self._filter_task = asyncio.ensure_future(self._update_filter(self._filter_task))
+
+    async def _update_filter(self, previous=None):
+        """Install the tightest filter (or topic subscriptions) covering all
+           subscriptions on the event connection, so unused traffic never
+           leaves the daemon. Runs after the previous update completed."""
+        if previous is not None and not previous.done():
+            await asyncio.wait((previous,))
+        self._filter_pending = False
+        if self._filter is None:
+            return  # not receiving yet, start_update installs the filter
+        patterns = self.dispatcher.patterns()
+        subscription = self._events.subscription(patterns)
+        if subscription == self._filter:
+            return
+        self._filter = subscription
+        logger.debug('Daemon subscription {}'.format(self._filter))
+        try:
+            await self._events.subscribe(patterns)
+        except Exception:
+            logger.exception('Failed to update the daemon filter')
 
     async def start_update(self):
-        await self.quitloop()
-        flt = Filter(0,0,0,0,0,0)
-        await self.setmask(flt)
-        await self.setfilter(flt)
-        await self.clrall()
-        await self.rcvloop(self._process_event)
-
-    async def scan(self, updater):
-        """Scan a gateway for devices, build the channel lists"""
-        await self.quitloop()
-
-        for nickname in range(128):
-            (guid, mdf) = await who_is_there(self, nickname)
-
-            if (guid, mdf) != (None, None):
-                node = await Node.new(self, nickname, guid, mdf, updater)
-                self.nodes[nickname] = node
+        await self._events.quitloop()
+        await self._start_receiving()
+
+    async def _start_receiving(self):
+        """Install the daemon filter and start the receive loop of the event connection"""
+        patterns = self.dispatcher.patterns()
+        self._filter = self._events.subscription(patterns)
+        await self._events.subscribe(patterns)
+        await self._events.clrall()
+        await self._events.rcvloop(batch_callback=self._process_events)
+        self._receiving.set()
+
+    def load_cache(self, cache):
+        """Restore nodes from the discovery cache, keyed by GUID"""
+        for guid, entry in cache.items():
+            try:
+                node = Node.from_cache(self, Guid.from_string(guid), entry, self)
+            except (KeyError, ValueError, IndexError):
+                logger.warning('Ignoring invalid discovery cache entry for {}'.format(guid))
+                continue
+            self.nodes[node.nickname] = node
+
+    def to_cache(self):
+        return {str(node.guid): node.to_cache() for node in self.nodes.values()}
+
+    async def scan(self, on_node=None):
+        """Scan a gateway for devices, build the channel lists.
+
+        Nodes restored from the cache are only revalidated, they are read
+        again when their configuration changed. Returns the list of channels
+        which were created by this scan. on_node(channels) is called with the
+        channels created for a node as soon as that node is read, a slow or
+        failing node does not hold back the others. Known nodes which did
+        not answer or could not be read are marked unavailable.
+
+        All nodes are read concurrently, the load on the bus is bounded by
+        the number of register reads in flight (max_reads) and their rate
+        (background_rate)."""
+        self.scan_complete = False
+        found = await who_is_there_all(self.command_connection(), priority=PRIORITY[DISCOVERY])
+        failed = []
+
+        async def scan_one(nickname):
+            try:
+                created = await self._scan_node(nickname, *found[nickname])
+            except Exception as e:
+                logger.error('Failed to read node {}: {!r}'.format(nickname, e))
+                failed.append(nickname)
+                if nickname in self.nodes:
+                    self.nodes[nickname].available = False
+                return []
+            self.nodes[nickname].available = True
+            if created and on_node is not None:
+                on_node(created)
+            return created
+
+        results = await asyncio.gather(*[scan_one(nickname) for nickname in sorted(found)])
+        self.scan_complete = not failed
+        for nickname, node in self.nodes.items():
+            if nickname not in found:
+                logger.warning('Node {} did not answer the scan'.format(nickname))
+                node.available = False
+        self._notify_state()
+        return [ch for created in results for ch in created]
+
+    async def _scan_node(self, nickname, guid, mdf):
+        node = self.nodes.get(nickname)
+        if node is None or node.guid != guid or node.mdf != mdf:
+            if node is not None:
+                logger.warning('Node {} changed identity, restart to remove its old entities'.format(nickname))
+            node = await Node.new(self, nickname, guid, mdf, self)
+            self.nodes[nickname] = node
+            return node.all_channels()
+        elif not await node.revalidate():
+            logger.info('Configuration of node {} changed, reloading'.format(nickname))
+            return await node.reload()
+        return []
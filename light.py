@@ -3,6 +3,8 @@ import struct
 import voluptuous as vol
 import homeassistant.helpers.config_validation as cv
 from homeassistant.const import (CONF_ENTITIES, CONF_NAME, CONF_ZONE)
+from homeassistant.core import callback
+from homeassistant.helpers.dispatcher import async_dispatcher_connect
 
 
 from homeassistant.components.light import (
@@ -15,16 +17,15 @@ from homeassistant.components.light import (
 )
 
 from .channel import Channel
+from .throttle import StateWriter
 
-from .const import DOMAIN, GATEWAY, SCANNER, CONF_SUBZONE
+from .const import DOMAIN, GATEWAY, STATE_INTERVAL, LIGHTS, CONF_SUBZONE, CONF_GATEWAY, SIGNAL_NEW_CHANNELS
 
 from .vscp.event import Event
 from .vscp.const import (CLASS_CONTROL, CLASS_INFORMATION,
                          EVENT_INFORMATION_ON, EVENT_INFORMATION_OFF, EVENT_INFORMATION_LEVEL,
                          EVENT_CONTROL_TURN_ON, EVENT_CONTROL_TURN_OFF, EVENT_CHANGE_LEVEL)
 
-from .vscp.util import read_reg
-
 logger = logging.getLogger(__name__)
 
 IDENTIFIER = 'LI'
@@ -40,17 +41,37 @@ DEVICE_SCHEMA = vol.Schema(
 PLATFORM_SCHEMA = PLATFORM_SCHEMA.extend(
     {
         vol.Required(CONF_ENTITIES): [DEVICE_SCHEMA],
+        vol.Optional(CONF_GATEWAY): cv.string,
     }
 )
 
 async def async_setup_platform(hass, config, async_add_entities, discovery_info=None):
+    gateways = hass.data[DOMAIN][GATEWAY]
     if discovery_info is None:
-        u = hass.data[DOMAIN][GATEWAY]
+        name = config.get(CONF_GATEWAY)
+        if name is None and len(gateways) == 1:
+            name = next(iter(gateways))
+        if name not in gateways:
+            logger.error('VSCP zone lights need the name of one of the configured gateways')
+            return False
+        u = gateways[name]
         async_add_entities([zoneLight(u, e.get(CONF_NAME), e.get(CONF_ZONE), e.get(CONF_SUBZONE)) for e in config.get(CONF_ENTITIES)])
         logger.debug('VSCP adding zone lights: [{}]'.format(','.join([e.get(CONF_NAME) for e in config.get(CONF_ENTITIES)])))
     else:
-        for node in hass.data[DOMAIN][SCANNER].nodes.values():
-            async_add_entities([ch for ch in node.get_channels(IDENTIFIER) if ch.enabled])
+        gw = gateways[discovery_info[CONF_GATEWAY]]
+        added = set()  # unique ids, a node read while loading may be signalled as well
+
+        @callback
+        def async_add_channels(channels):
+            """Add channels found after the platform was loaded"""
+            new = [ch for ch in channels if isinstance(ch, vscpLight) and ch.enabled and ch.unique_id not in added]
+            added.update(ch.unique_id for ch in new)
+            async_add_entities(new)
+
+        for node in gw.nodes.values():
+            async_add_channels(node.get_channels(IDENTIFIER))
+
+        async_dispatcher_connect(hass, SIGNAL_NEW_CHANNELS.format(gw.name), async_add_channels)
     return True
 
 
@@ -62,11 +83,45 @@ class zoneLight(LightEntity):
         self._subzone = subzone
         self._enabled = False
         self._state = False
+        # fixed frames at interactive priority, encoded once and reused for every command
+        self._ev_on = Event(vscp_class=CLASS_CONTROL,
+                            vscp_type=EVENT_CONTROL_TURN_ON,
+                            head=updater.priority() << 5,
+                            data=struct.pack('>BBB', 0, self._zone, self._subzone))
+        self._ev_off = Event(vscp_class=CLASS_CONTROL,
+                             vscp_type=EVENT_CONTROL_TURN_OFF,
+                             head=updater.priority() << 5,
+                             data=struct.pack('>BBB', 0, self._zone, self._subzone))
 
     async def async_added_to_hass(self):
         await super().async_added_to_hass()
-        await self._updater.sub_zone_event(CLASS_INFORMATION, EVENT_INFORMATION_ON, self._zone, self._subzone, self._handle_onoff_event)
-        await self._updater.sub_zone_event(CLASS_INFORMATION, EVENT_INFORMATION_OFF, self._zone, self._subzone, self._handle_onoff_event)
+        self._state_writer = StateWriter(self, self.hass.data[DOMAIN][STATE_INTERVAL][self._updater.name],
+                                         self._updater.metrics)
+        self._subscriptions = [
+            await self._updater.sub_zone_event(CLASS_INFORMATION, EVENT_INFORMATION_ON, self._zone, self._subzone, self._handle_onoff_event),
+            await self._updater.sub_zone_event(CLASS_INFORMATION, EVENT_INFORMATION_OFF, self._zone, self._subzone, self._handle_onoff_event)]
+        self._updater.add_state_listener(self.async_write_ha_state)
+        self.hass.data[DOMAIN][LIGHTS][self.entity_id] = self
+
+    async def async_will_remove_from_hass(self):
+        for subscription in self._subscriptions:
+            subscription.unsubscribe()
+        self._updater.remove_state_listener(self.async_write_ha_state)
+        self._state_writer.cancel()
+        self.hass.data[DOMAIN][LIGHTS].pop(self.entity_id, None)
+
+    @property
+    def address(self):
+        """(zone, subzone) the light is controlled on"""
+        return (self._zone, self._subzone)
+
+    @property
+    def gateway(self):
+        return self._updater
+
+    @property
+    def supports_level(self):
+        return False
 
     @property
     def enabled(self):
@@ -74,17 +129,16 @@ class zoneLight(LightEntity):
 
     @property
     def unique_id(self):
-        return "LI-{}-{}-{}".format(self._name, self._zone, self._subzone)
+        return "LI-{}{}-{}-{}".format(self._updater.namespace, self._name, self._zone, self._subzone)
 
     @property
     def name(self):
         """Return the display name of this light."""
         return self._name
 
-    # when a node goes offline, we can disable it's channels
     @property
     def available(self):
-        return True
+        return self._updater.connected
 
     @property
     def should_poll(self):
@@ -102,34 +156,32 @@ class zoneLight(LightEntity):
     async def async_turn_on(self, **kwargs):
         """Instruct the light to turn on."""
         logger.debug('Turning on {}'.format(self._name))
-        ev = Event(vscp_class=CLASS_CONTROL,
-                   vscp_type=EVENT_CONTROL_TURN_ON,
-                   data=struct.pack('>BBB', 0, self._zone, self._subzone))
-        await self._updater.send(ev)
+        await self._updater.send(self._ev_on, confirm=True)
 
     async def async_turn_off(self, **kwargs):
         """Instruct the light to turn off."""
         logger.debug('Turning off {}'.format(self.name))
-        ev = Event(vscp_class=CLASS_CONTROL,
-                   vscp_type=EVENT_CONTROL_TURN_OFF,
-                   data=struct.pack('>BBB', 0, self._zone, self._subzone))
-        await self._updater.send(ev)
+        await self._updater.send(self._ev_off, confirm=True)
 
     async def _handle_onoff_event(self, event):
         logger.debug('Got on/off for {}'.format(self.name))
         self._state = (event.vscp_type == EVENT_INFORMATION_ON)
-        self.async_schedule_update_ha_state()
+        self._state_writer.schedule(event)
 
 
 class vscpLight(LightEntity, Channel):
     """Representation of a VSCP4HASS Light."""
+    STATE_REGISTERS = (0x05, 0x08)
+
     @classmethod
-    async def new(cls, node, channel):
-        self = cls()
-        self._node = node
-        self._channel = channel
+    def from_registers(cls, node, channel, registers):
+        self = super().from_registers(node, channel, registers)
+        # only set once, the entity registry or the user may change it later
+        self.entity_id = "light.vscp.{}{}.{}".format(node.updater.namespace, node.guid, channel)
+        return self
 
-        registers = await read_reg(node.bus, node.nickname, channel, 0, 34)
+    def apply_registers(self, registers):
+        self.registers = bytes(registers)
         self._enabled = (registers[0x03] != 0x00)
         self._supports_brightness = (registers[0x04] & 0x01 == 0x01)
         self._supports_flash = (registers[0x04] & 0x08 == 0x08)
@@ -138,18 +190,51 @@ class vscpLight(LightEntity, Channel):
         self._subzone = int(registers[0x07])
         self._brightness = int(registers[0x08])
         self._name = registers[16:33].decode().rstrip('/x0')
-        self.entity_id = "light.vscp.{}.{}".format(self._node.guid, self._channel)
-        return self
+        # fixed frames at interactive priority, encoded once and reused for every command
+        self._ev_on = Event(vscp_class=CLASS_CONTROL,
+                            vscp_type=EVENT_CONTROL_TURN_ON,
+                            head=self._node.updater.priority() << 5,
+                            data=struct.pack('>BBB', 0, self._zone, self._subzone))
+        self._ev_off = Event(vscp_class=CLASS_CONTROL,
+                             vscp_type=EVENT_CONTROL_TURN_OFF,
+                             head=self._node.updater.priority() << 5,
+                             data=struct.pack('>BBB', 0, self._zone, self._subzone))
 
     async def async_added_to_hass(self):
         await super().async_added_to_hass()
-        await self._node.updater.sub_ch_event(self._node.nickname, self._channel, CLASS_INFORMATION, EVENT_INFORMATION_ON,
-                                              self._handle_onoff_event)
-        await self._node.updater.sub_ch_event(self._node.nickname, self._channel, CLASS_INFORMATION, EVENT_INFORMATION_OFF,
-                                              self._handle_onoff_event)
+        self._state_writer = StateWriter(self, self.hass.data[DOMAIN][STATE_INTERVAL][self._node.updater.name],
+                                         self._node.updater.metrics)
+        self._subscriptions = [
+            await self._node.updater.sub_ch_event(self._node.nickname, self._channel, CLASS_INFORMATION, EVENT_INFORMATION_ON,
+                                                  self._handle_onoff_event),
+            await self._node.updater.sub_ch_event(self._node.nickname, self._channel, CLASS_INFORMATION, EVENT_INFORMATION_OFF,
+                                                  self._handle_onoff_event)]
         if self._supports_brightness:
-            await self._node.updater.sub_ch_event(self._node.nickname, self._channel, CLASS_INFORMATION, EVENT_INFORMATION_LEVEL,
-                                                  self._handle_level_event)
+            self._subscriptions.append(
+                await self._node.updater.sub_ch_event(self._node.nickname, self._channel, CLASS_INFORMATION, EVENT_INFORMATION_LEVEL,
+                                                      self._handle_level_event))
+        self._node.updater.add_state_listener(self.async_write_ha_state)
+        self.hass.data[DOMAIN][LIGHTS][self.entity_id] = self
+
+    async def async_will_remove_from_hass(self):
+        for subscription in self._subscriptions:
+            subscription.unsubscribe()
+        self._node.updater.remove_state_listener(self.async_write_ha_state)
+        self._state_writer.cancel()
+        self.hass.data[DOMAIN][LIGHTS].pop(self.entity_id, None)
+
+    @property
+    def address(self):
+        """(zone, subzone) the light is controlled on"""
+        return (self._zone, self._subzone)
+
+    @property
+    def gateway(self):
+        return self._node.updater
+
+    @property
+    def supports_level(self):
+        return self._supports_brightness
 
     @property
     def enabled(self):
@@ -157,17 +242,17 @@ class vscpLight(LightEntity, Channel):
 
     @property
     def unique_id(self):
-        return "LI-{}-{}".format(self._node.guid, self._channel)
+        return "LI-{}{}-{}".format(self._node.updater.namespace, self._node.guid, self._channel)
 
     @property
     def name(self):
         """Return the display name of this light."""
         return self._name
 
-    # when a node goes offline, we can disable it's channels
+    # unavailable while the daemon is unreachable or the node did not answer the scan or resync
     @property
     def available(self):
-        return True
+        return self._node.updater.connected and self._node.available
 
     @property
     def should_poll(self):
@@ -205,10 +290,12 @@ class vscpLight(LightEntity, Channel):
             if kwargs[ATTR_FLASH] == 'long':
                 flash_cmd = 2
 
-        ev = Event(vscp_class=CLASS_CONTROL,
-                   vscp_type=EVENT_CONTROL_TURN_ON,
-                   data=struct.pack('>BBB', flash_cmd, self._zone, self._subzone))
-        await self._node.updater.send(ev)
+        if flash_cmd == 0:
+            events = [self._ev_on]
+        else:
+            events = [Event(vscp_class=CLASS_CONTROL,
+                            vscp_type=EVENT_CONTROL_TURN_ON,
+                            data=struct.pack('>BBB', flash_cmd, self._zone, self._subzone))]
 
         if self._supports_brightness and ATTR_BRIGHTNESS in kwargs:
             brightness = kwargs[ATTR_BRIGHTNESS]
@@ -217,18 +304,15 @@ class vscpLight(LightEntity, Channel):
             if brightness < 0:
                 brightness = 0
 
-            ev = Event(vscp_class=CLASS_CONTROL,
-                       vscp_type=EVENT_CHANGE_LEVEL,
-                       data=struct.pack('>BBB', brightness, self._zone, self._subzone))
-            await self._node.updater.send(ev)
+            events.append(Event(vscp_class=CLASS_CONTROL,
+                                vscp_type=EVENT_CHANGE_LEVEL,
+                                data=struct.pack('>BBB', brightness, self._zone, self._subzone)))
+        await self._node.updater.send_many(events, confirm=True)
 
     async def async_turn_off(self, **kwargs):
         """Instruct the light to turn off."""
         logger.debug('Turning off {}'.format(self.name))
-        ev = Event(vscp_class=CLASS_CONTROL,
-                   vscp_type=EVENT_CONTROL_TURN_OFF,
-                   data=struct.pack('>BBB', 0, self._zone, self._subzone))
-        await self._node.updater.send(ev)
+        await self._node.updater.send(self._ev_off, confirm=True)
 
     @property
     def should_poll(self):
@@ -237,8 +321,8 @@ class vscpLight(LightEntity, Channel):
     async def _handle_onoff_event(self, event):
         logger.debug('Got on/off for {}'.format(self.name))
         self._state = (event.vscp_type == EVENT_INFORMATION_ON)
-        self.async_schedule_update_ha_state()
+        self._state_writer.schedule(event)
 
     async def _handle_level_event(self, event):
         self._brightness = struct.unpack('>BBBB', event.data)[3]
-        self.async_schedule_update_ha_state()
+        self._state_writer.schedule(event)
@@ -1,38 +1,197 @@
+import asyncio
+import zlib
 from .vscp.const import (STD_REG_STD_DEV,
-                         STD_REG_PAGES,
-                         STD_REG_UID)
-from .vscp.util import write_reg, read_reg, read_std_reg
-from .channel import channel_reg
+                         STD_REG_LENGTH)
+from .vscp.shadow import ShadowRegisters
+from .vscp.scheduler import RESYNC, DISCOVERY
+from .channel import channel_reg, BLOCK_SIZE
 
 CHANNEL_TYPE = 0
 CHANNEL_TYPE_SIZE = 2
+CHANNEL_TYPE_END = b'\0\0'
+
+# number of page reads kept in flight while enumerating a node
+READ_WINDOW = 8
 
 class Node:
-    @classmethod
-    async def new(cls, bus, nickname, guid=None, mdf=None, updater=None):
-        self = cls()
+    def __init__(self, bus, nickname, guid=None, mdf=None, updater=None):
         self.bus = bus
         self.updater = updater
         self.nickname = nickname
         self.guid = guid
-        self.stddev = await read_std_reg(bus, nickname, STD_REG_STD_DEV)
+        self.mdf = mdf
+        self.stddev = None
+        self.is_vscp4hass = False
+        self.channels = dict()
+        for channel_type in channel_reg:
+            self.channels[channel_type] = dict()
+        self._types = []  # channel type of every page, up to and including the end marker
+        self.checksum = None
+        self.available = True  # False when the node did not answer the last scan or resync
+        self.registers = ShadowRegisters(bus, nickname, bus.priority(DISCOVERY), traffic=DISCOVERY)
+
+    @classmethod
+    async def new(cls, bus, nickname, guid=None, mdf=None, updater=None):
+        self = cls(bus, nickname, guid, mdf, updater)
+        self.stddev = await self.registers.read(0, STD_REG_STD_DEV, STD_REG_LENGTH[STD_REG_STD_DEV])
 
         self.is_vscp4hass = True if self.stddev == b'HASS\0\0\0\0' else False
 
         if self.is_vscp4hass:
-            self.channels = dict()
-            for channel_type in channel_reg:
-                self.channels[channel_type] = dict()
+            await self.reload()
 
-            for channel in range(256):
-                channel_type = (await read_reg(bus, nickname, channel, CHANNEL_TYPE, num=CHANNEL_TYPE_SIZE)).decode("utf-8")
-                if channel_type == b'\0\0'.decode("utf-8"):
-                    break
-                elif channel_type in channel_reg:
-                    self.channels[channel_type][(nickname, channel)] = await channel_reg[channel_type].new(self, channel)
+        return self
 
+    @classmethod
+    def from_cache(cls, bus, guid, entry, updater=None):
+        """Rebuild a node and its channels from a discovery cache entry"""
+        self = cls(bus, entry['nickname'], guid, entry['mdf'], updater)
+        self.stddev = bytes.fromhex(entry['stddev'])
+        self.is_vscp4hass = True if self.stddev == b'HASS\0\0\0\0' else False
+        self._types = [bytes.fromhex(t) for t in entry['types']]
+        for channel, registers in entry['channels'].items():
+            channel = int(channel)
+            channel_type = self._types[channel].decode("utf-8")
+            self._add(channel_reg[channel_type].from_registers(self, channel, bytes.fromhex(registers)))
+        self.checksum = entry['checksum']
         return self
 
+    def to_cache(self):
+        """Return a JSON serializable description of the node"""
+        return {'nickname': self.nickname,
+                'mdf': self.mdf,
+                'stddev': self.stddev.hex(),
+                'types': [t.hex() for t in self._types],
+                'channels': {str(ch.index): ch.registers.hex() for ch in self.all_channels()},
+                'checksum': self.checksum}
+
+    def _add(self, channel):
+        self.channels[channel.identifier()][(self.nickname, channel.index)] = channel
+
+    def all_channels(self):
+        return [ch for channels in self.channels.values() for ch in channels.values()]
+
+    def _find(self, channel_type, channel):
+        if channel_type not in self.channels:
+            return None
+        return self.channels[channel_type].get((self.nickname, channel))
+
+    def _checksum(self, types, blocks):
+        crc = zlib.crc32(b''.join(types))
+        for channel in sorted(blocks):
+            channel_type = types[channel].decode("utf-8")
+            crc = zlib.crc32(channel_reg[channel_type].config_bytes(blocks[channel]), crc)
+        return crc
+
+    async def _read_pages(self, pages, cached=True):
+        """Read the register block of a number of pages, keeping up to
+           READ_WINDOW reads in flight. Returns a list of blocks. Blocks in
+           the shadow registers are only read again without cached."""
+        pages = list(pages)
+        blocks = []
+        for start in range(0, len(pages), READ_WINDOW):
+            blocks.extend(await asyncio.gather(
+                *[self.registers.read(page, 0, BLOCK_SIZE, cached)
+                  for page in pages[start:start + READ_WINDOW]]))
+        return blocks
+
+    async def _read_all_pages(self):
+        """Read pages until the end marker, a window of pages at a time. The
+           first window spans the pages known from the cache, if any. Reads
+           past the end marker are cancelled once it arrived, pages beyond
+           it may not exist and failing to read them is not an error."""
+        blocks = []
+        start = 0
+        window = len(self._types) or READ_WINDOW
+        while start < 256:
+            tasks = [asyncio.ensure_future(self.registers.read(page, 0, BLOCK_SIZE))
+                     for page in range(start, min(start + window, 256))]
+            try:
+                for task in tasks:
+                    registers = await task
+                    blocks.append(registers)
+                    if registers[CHANNEL_TYPE:CHANNEL_TYPE + CHANNEL_TYPE_SIZE] == CHANNEL_TYPE_END:
+                        return blocks
+            finally:
+                for task in tasks:
+                    if not task.done():
+                        task.cancel()
+                    elif not task.cancelled():
+                        task.exception()  # retrieved, the page may not exist
+            start += len(tasks)
+            window = READ_WINDOW
+        return blocks
+
+    async def reload(self):
+        """Read all channels from the node. Channels which exist already are
+           updated in place, returns the list of newly created channels.
+
+        Type and configuration of a channel are read in one request."""
+        types = []
+        blocks = dict()
+        created = []
+        for channel, registers in enumerate(await self._read_all_pages()):
+            channel_type = registers[CHANNEL_TYPE:CHANNEL_TYPE + CHANNEL_TYPE_SIZE]
+            types.append(channel_type)
+            if channel_type == CHANNEL_TYPE_END:
+                break
+            channel_type = channel_type.decode("utf-8")
+            if channel_type in channel_reg:
+                existing = self._find(channel_type, channel)
+                if existing is None:
+                    existing = channel_reg[channel_type].from_registers(self, channel, registers)
+                    self._add(existing)
+                    created.append(existing)
+                else:
+                    existing.update_registers(registers)
+                blocks[channel] = registers
+
+        self._types = types
+        self.checksum = self._checksum(types, blocks)
+        return created
+
+    async def revalidate(self):
+        """Check a node restored from the cache against the bus.
+
+        Reads the register block of all pages known from the cache from the
+        bus, a reload() after a change takes them from the shadow. Returns
+        False when the configuration changed, otherwise the fresh state is
+        applied to the channels and True is returned."""
+        if not self.is_vscp4hass:
+            return True
+        types = []
+        blocks = dict()
+        for channel, registers in enumerate(await self._read_pages(range(len(self._types)), cached=False)):
+            channel_type = registers[CHANNEL_TYPE:CHANNEL_TYPE + CHANNEL_TYPE_SIZE]
+            types.append(channel_type)
+            if channel_type != CHANNEL_TYPE_END and self._find(channel_type.decode("utf-8"), channel) is not None:
+                blocks[channel] = registers
+
+        if types != self._types or self._checksum(types, blocks) != self.checksum:
+            return False
+
+        for channel, registers in blocks.items():
+            self._find(types[channel].decode("utf-8"), channel).update_registers(registers)
+        return True
+
+    async def resync(self):
+        """Read the state registers of all channels again, after the
+           connection to the daemon was restored. Configuration is not read."""
+        channels = [ch for ch in self.all_channels() if ch.STATE_REGISTERS]
+        try:
+            for start in range(0, len(channels), READ_WINDOW):
+                window = channels[start:start + READ_WINDOW]
+                results = await asyncio.gather(*[self.registers.read(ch.index, *ch.state_span(), cached=False,
+                                                                     priority=self.bus.priority(RESYNC),
+                                                                     traffic=RESYNC)
+                                                 for ch in window])
+                for channel, values in zip(window, results):
+                    channel.update_state(bytes(values))
+        except Exception:
+            self.available = False
+            raise
+        self.available = True
+
     def get_channels(self, identifier):
         if not self.is_vscp4hass:
             return list()
@@ -0,0 +1,131 @@
+import logging
+from datetime import timedelta
+
+from .const import DOMAIN, GATEWAY, CONF_GATEWAY
+
+from homeassistant.components.sensor import SensorEntity
+from homeassistant.helpers.entity import EntityCategory
+
+_LOGGER = logging.getLogger(__name__)
+
+# metrics are sampled, histograms report the observations between two updates
+SCAN_INTERVAL = timedelta(seconds=30)
+
+
+def _ms(value):
+    return None if value is None else round(value * 1000, 2)
+
+
+def _us(value):
+    return None if value is None else round(value * 1e6, 1)
+
+
+async def async_setup_platform(hass, config, async_add_entities, discovery_info=None):
+    if discovery_info is None:
+        return
+    gw = hass.data[DOMAIN][GATEWAY][discovery_info[CONF_GATEWAY]]
+    if gw.metrics is None:
+        return
+    m = gw.metrics
+    async_add_entities([
+        vscpRateSensor(gw, 'received', 'Events received', m.received),
+        vscpRateSensor(gw, 'sent', 'Events sent', m.sent),
+        vscpHistogramSensor(gw, 'parse_time', 'Parse time', 'µs', lambda: m.parse_time, 'mean', _us),
+        vscpHistogramSensor(gw, 'dispatch_time', 'Dispatch time', 'µs', lambda: m.dispatch_time, 'mean', _us),
+        vscpHistogramSensor(gw, 'command_rtt', 'Command round trip', 'ms', lambda: m.command_rtt, 'p95', _ms),
+        vscpHistogramSensor(gw, 'read_latency', 'Register read latency', 'ms', lambda: m.read_latency, 'p95', _ms),
+        vscpHistogramSensor(gw, 'end_to_end', 'End-to-end latency', 'ms', lambda: m.end_to_end, 'p95', _ms),
+        vscpValueSensor(gw, 'outbox_depth', 'Outbox depth', 'events', lambda: gw.outbox_depth,
+                        lambda: {'peak': m.outbox_depth.max}),
+        vscpValueSensor(gw, 'read_retries', 'Register read retries', None, lambda: m.read_retries,
+                        lambda: {'timeouts': m.read_timeouts}),
+        vscpValueSensor(gw, 'state_writes', 'State writes', None, lambda: m.state_writes,
+                        lambda: {'suppressed': m.state_suppressed}),
+    ])
+    return True
+
+
+class vscpMetricSensor(SensorEntity):
+    """Base class of the diagnostic sensors on the gateway metrics"""
+    def __init__(self, gateway, key, name, unit):
+        self._gateway = gateway
+        self._key = key
+        self._name = 'VSCP ' + name if gateway.name is None else 'VSCP {} {}'.format(gateway.name, name)
+        self._unit = unit
+        self._state = None
+        self._attributes = dict()
+
+    @property
+    def unique_id(self):
+        return "metrics-{}{}".format(self._gateway.namespace, self._key)
+
+    @property
+    def name(self):
+        return self._name
+
+    @property
+    def entity_category(self):
+        return EntityCategory.DIAGNOSTIC
+
+    @property
+    def native_unit_of_measurement(self):
+        return self._unit
+
+    @property
+    def native_value(self):
+        return self._state
+
+    @property
+    def extra_state_attributes(self):
+        return self._attributes
+
+    @property
+    def should_poll(self):
+        return True
+
+
+class vscpRateSensor(vscpMetricSensor):
+    """Events per second, the attributes break it down per class,type"""
+    def __init__(self, gateway, key, name, counter):
+        super().__init__(gateway, key, name, 'events/s')
+        self._counter = counter
+
+    async def async_update(self):
+        rates = self._counter.rates()
+        self._state = round(sum(rates.values()), 1)
+        self._attributes = {'{},{}'.format(*key): round(rate, 1) for key, rate in rates.items() if rate}
+        self._attributes['total'] = self._counter.total()
+
+
+class vscpHistogramSensor(vscpMetricSensor):
+    """A statistic of a histogram over the last update interval"""
+    def __init__(self, gateway, key, name, unit, histogram, statistic, scale):
+        super().__init__(gateway, key, name, unit)
+        self._histogram = histogram
+        self._statistic = statistic
+        self._scale = scale
+        self._previous = None
+
+    async def async_update(self):
+        histogram = self._histogram()
+        window = histogram.delta(self._previous)
+        self._previous = histogram.copy()
+        stats = {'mean': window.mean,
+                 'p50': window.percentile(0.5),
+                 'p95': window.percentile(0.95),
+                 'p99': window.percentile(0.99)}
+        self._state = self._scale(stats[self._statistic])
+        self._attributes = {name: self._scale(value) for name, value in stats.items()}
+        self._attributes['count'] = window.count
+        self._attributes['max'] = self._scale(histogram.max)
+
+
+class vscpValueSensor(vscpMetricSensor):
+    def __init__(self, gateway, key, name, unit, value, attributes):
+        super().__init__(gateway, key, name, unit)
+        self._value = value
+        self._get_attributes = attributes
+
+    async def async_update(self):
+        self._state = self._value()
+        self._attributes = self._get_attributes()
@@ -0,0 +1,168 @@
+"""Minimal MQTT 3.1.1 broker, a local stand-in for testing the MQTT transport.
+
+Handles clean sessions only: CONNECT, SUBSCRIBE/UNSUBSCRIBE with + and #
+wildcards, PUBLISH with QoS 0 and 1 (delivered with QoS 0), PINGREQ and
+DISCONNECT. Every message is delivered once per client, whatever the number
+of matching subscriptions. Used by uvscpd.py --protocol mqtt, which bridges
+the simulated segment onto it; it can also run on its own:
+    python sim/broker.py --port 1883
+"""
+import argparse
+import asyncio
+import logging
+import os
+import struct
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from vscp.mqtt import (CONNECT, CONNACK, PUBLISH, PUBACK, SUBSCRIBE, SUBACK,  # noqa: E402
+                       UNSUBSCRIBE, UNSUBACK, PINGREQ, PINGRESP, DISCONNECT,
+                       packet, publish_packet, topic_match)
+
+logger = logging.getLogger('mqtt-sim')
+
+DEF_PORT = 1883
+
+_PID = struct.Struct('>H')
+
+
+def _strings(body, offset):
+    """Yield the length prefixed strings in body from offset on"""
+    while offset < len(body):
+        (length,) = _PID.unpack_from(body, offset)
+        yield body[offset + 2:offset + 2 + length].decode()
+        offset += 2 + length
+
+
+class Session:
+    """One client connection"""
+    def __init__(self, broker, reader, writer):
+        self.broker = broker
+        self.reader = reader
+        self.writer = writer
+        self.subscriptions = set()
+        self.client_id = None
+        self.task = None
+
+    def deliver(self, topic, data):
+        if any(topic_match(sub, topic) for sub in self.subscriptions):
+            self.writer.write(data)
+
+    async def read_packet(self):
+        first = (await self.reader.readexactly(1))[0]
+        length = 0
+        for shift in range(0, 28, 7):
+            byte = (await self.reader.readexactly(1))[0]
+            length |= (byte & 0x7F) << shift
+            if not byte & 0x80:
+                break
+        return first, await self.reader.readexactly(length)
+
+    async def run(self):
+        try:
+            (first, body) = await self.read_packet()
+            if first != CONNECT:
+                return
+            self.client_id = next(_strings(body, 10))
+            self.writer.write(packet(CONNACK, b'\x00\x00'))
+            while True:
+                (first, body) = await self.read_packet()
+                if not self.handle(first, body):
+                    break
+                if self.writer.transport.get_write_buffer_size() > 65536:
+                    await self.writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self.broker.sessions.discard(self)
+            self.writer.close()
+
+    def handle(self, first, body):
+        kind = first & 0xF0
+        if kind == PUBLISH:
+            qos = (first >> 1) & 0x03
+            (length,) = _PID.unpack_from(body)
+            topic = body[2:2 + length].decode()
+            offset = 2 + length
+            if qos:
+                self.writer.write(packet(PUBACK, body[offset:offset + 2]))
+                offset += 2
+            self.broker.route(topic, body[offset:], origin=self)
+        elif first == SUBSCRIBE:
+            # every topic is followed by its requested QoS byte
+            topics = []
+            offset = 2
+            while offset < len(body):
+                (length,) = _PID.unpack_from(body, offset)
+                topics.append(body[offset + 2:offset + 2 + length].decode())
+                offset += 3 + length
+            self.subscriptions.update(topics)
+            self.writer.write(packet(SUBACK, body[:2] + bytes(len(topics))))
+        elif first == UNSUBSCRIBE:
+            self.subscriptions.difference_update(_strings(body, 2))
+            self.writer.write(packet(UNSUBACK, body[:2]))
+        elif first == PINGREQ:
+            self.writer.write(packet(PINGRESP))
+        elif first == DISCONNECT:
+            return False
+        else:
+            logger.warning('Unsupported packet %x from %s', first, self.client_id)
+            return False
+        return True
+
+
+class Broker:
+    """The broker, on_publish(topic, payload) is called for every message
+       published by a client"""
+    def __init__(self, on_publish=None):
+        self.sessions = set()
+        self.on_publish = on_publish
+        self.server = None
+
+    def route(self, topic, payload, origin=None):
+        data = publish_packet(topic, payload)
+        for session in list(self.sessions):
+            session.deliver(topic, data)
+        if origin is not None and self.on_publish is not None:
+            self.on_publish(topic, payload)
+
+    def publish(self, topic, payload):
+        """Publish a message from the broker side, on_publish is not called"""
+        self.route(topic, payload)
+
+    async def _session(self, reader, writer):
+        session = Session(self, reader, writer)
+        session.task = asyncio.current_task()
+        self.sessions.add(session)
+        await session.run()
+
+    async def start(self, host='127.0.0.1', port=DEF_PORT):
+        self.server = await asyncio.start_server(self._session, host, port)
+        return self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self.server.close()
+        tasks = [session.task for session in self.sessions]
+        for session in list(self.sessions):
+            session.writer.close()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await self.server.wait_closed()
+
+
+async def serve(args):
+    broker = Broker()
+    port = await broker.start(args.host, args.port)
+    logger.info('listening on %s:%d', args.host, port)
+    await broker.server.serve_forever()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description='Minimal MQTT broker')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=DEF_PORT)
+    try:
+        asyncio.run(serve(parser.parse_args()))
+    except KeyboardInterrupt:
+        pass
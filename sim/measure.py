@@ -0,0 +1,144 @@
+"""End-to-end measurements against the uvscpd simulator.
+
+Starts an in-process simulator, connects with vscp.tcp.TCP (or
+vscp.binary.BinaryTCP, vscp.mqtt.MQTT with --protocol binary/mqtt) and reports
+scan time (broadcast WHO_IS_THERE plus reading all channel blocks), register
+read latency and receive throughput. With --send-fault it checks that a
+confirmed send fails after the command timeout and drops the connection when
+the daemon does not answer it properly. Run from the repository root:
+    python sim/measure.py --nodes 128 --lights 8 --latency 0.002 --loss 0.01
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+
+SIM_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(SIM_DIR, '..'))
+sys.path.insert(0, SIM_DIR)
+
+from uvscpd import Daemon  # noqa: E402
+from vscp.binary import BinaryTCP  # noqa: E402
+from vscp.const import CLASS_VSCP, CLASS_INFORMATION  # noqa: E402
+from vscp.mqtt import MQTT  # noqa: E402
+from vscp.tcp import TCP  # noqa: E402
+from vscp.event import Event  # noqa: E402
+from vscp.transport import ResponseTimeout  # noqa: E402
+from vscp.util import who_is_there_all  # noqa: E402
+
+BLOCK_SIZE = 34
+
+TRANSPORTS = {'text': TCP, 'binary': BinaryTCP, 'mqtt': MQTT}
+
+
+async def measure_scan(bus, daemon, window):
+    start = time.perf_counter()
+    nodes = await who_is_there_all(bus, window)
+    identified = time.perf_counter()
+
+    async def read_node(nickname):
+        page = 0
+        while True:
+            block = await bus.read_registers(nickname, page, 0, BLOCK_SIZE)
+            if bytes(block[0:2]) == b'\0\0':
+                return page
+            page += 1
+
+    pages = await asyncio.gather(*[read_node(nickname) for nickname in nodes])
+    done = time.perf_counter()
+    print('scan: {} of {} nodes, {} channels, identify {:.3f}s (window {}s), read {:.3f}s'.format(
+        len(nodes), len(daemon.nodes), sum(pages), identified - start, window, done - identified))
+
+
+async def measure_reads(bus, daemon, count):
+    nicknames = list(daemon.nodes)
+    latencies = []
+    for i in range(count):
+        start = time.perf_counter()
+        await bus.read_registers(nicknames[i % len(nicknames)], 0, 0, BLOCK_SIZE)
+        latencies.append(time.perf_counter() - start)
+    latencies.sort()
+    print('read 34 registers: median {:.2f}ms, p95 {:.2f}ms, max {:.2f}ms'.format(
+        statistics.median(latencies) * 1000, latencies[int(len(latencies) * 0.95)] * 1000,
+        latencies[-1] * 1000))
+
+
+async def measure_receive(args, daemon, duration):
+    bus = TRANSPORTS[args.protocol](port=args.port)
+    await bus.connect()
+    await bus.subscribe({(CLASS_INFORMATION, None, None)})
+    received = 0
+
+    async def batch(events):
+        nonlocal received
+        received += len(events)
+
+    await bus.rcvloop(batch_callback=batch)
+    traffic = asyncio.ensure_future(daemon.traffic(args.traffic))
+    await asyncio.sleep(duration)
+    traffic.cancel()
+    await bus.close()
+    print('receive: {} events in {:.1f}s, {:.0f} events/s (offered {:.0f}/s)'.format(
+        received, duration, received / duration, args.traffic))
+
+
+async def measure_send_fault(args, daemon, timeout=1.0):
+    daemon.send_fault = args.send_fault
+    lost = []
+    bus = TRANSPORTS[args.protocol](port=args.port, command_timeout=timeout,
+                                    on_lost=lambda: lost.append(True))
+    await bus.connect()
+    await bus.rcvloop()
+    start = time.perf_counter()
+    try:
+        await bus.send(Event(vscp_class=CLASS_INFORMATION, vscp_type=3, data=bytearray(3)), confirm=True)
+        result = 'confirmed'
+    except ResponseTimeout:
+        result = 'timed out'
+    print('send fault {}: {} after {:.2f}s, connection {}'.format(
+        args.send_fault, result, time.perf_counter() - start, 'dropped' if lost else 'kept'))
+    await bus.close()
+    daemon.send_fault = None
+
+
+async def main(args):
+    daemon = Daemon(nodes=min(max(args.nodes, 1), 128), lights=args.lights, sensors=args.sensors,
+                    latency=args.latency, jitter=args.jitter, loss=args.loss, seed=args.seed)
+    args.port = await daemon.start(port=0, protocol=args.protocol)
+
+    bus = TRANSPORTS[args.protocol](port=args.port)
+    await bus.connect()
+    await bus.subscribe({(CLASS_VSCP, None, None)})
+    await bus.clrall()
+    await bus.rcvloop()
+    await measure_scan(bus, daemon, args.window)
+    await measure_reads(bus, daemon, args.reads)
+    await bus.close()
+
+    if args.traffic > 0:
+        await measure_receive(args, daemon, args.duration)
+    if args.send_fault is not None and args.protocol != 'mqtt':
+        await measure_send_fault(args, daemon)
+    print('frames: {} sent, {} lost'.format(daemon.frames_sent, daemon.frames_lost))
+    await daemon.stop()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--nodes', type=int, default=32)
+    parser.add_argument('--lights', type=int, default=4)
+    parser.add_argument('--sensors', type=int, default=2)
+    parser.add_argument('--latency', type=float, default=0.001)
+    parser.add_argument('--jitter', type=float, default=0.0)
+    parser.add_argument('--loss', type=float, default=0.0)
+    parser.add_argument('--window', type=float, default=0.2, help='WHO_IS_THERE collection window')
+    parser.add_argument('--reads', type=int, default=200, help='number of timed register reads')
+    parser.add_argument('--traffic', type=float, default=20000, help='offered events per second')
+    parser.add_argument('--duration', type=float, default=2.0, help='seconds of receive traffic')
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--protocol', choices=sorted(TRANSPORTS), default='text')
+    parser.add_argument('--send-fault', choices=('drop', 'keepalive'), default=None,
+                        help='check a confirmed send the daemon does not answer properly')
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,511 @@
+"""Local stand-in for uvscpd with simulated VSCP4HASS nodes.
+
+Speaks the text protocol used by vscp.tcp.TCP (welcome banner, USER/PASS,
+NOOP, SEND, RETR, CDTA, SFLT/SMSK, CLRA, RCVLOOP/QUITLOOP, QUIT), or with
+--protocol binary the framing of vscp.binary.BinaryTCP. With --protocol mqtt
+it runs the broker of broker.py instead and bridges the segment onto it
+(topics and payload of vscp.mqtt). Behind it
+sits a simulated segment of nodes with the 'HASS' standard device register
+layout and a number of light (LI) and binary sensor (BS) channels. The
+nodes answer WHO_IS_THERE and EXT_PAGE_READ/WRITE, follow CONTROL events
+for their zone/subzone and can generate on/off/level traffic. --send-fault
+makes the daemon lose the response to SEND (drop), or answer it with the bare
++OK of the text protocol keep-alive (keepalive, dropped as well with binary).
+With --sparse-pages nodes don't answer reads of pages past their end marker.
+
+Run from the repository root, for example:
+    python sim/uvscpd.py --nodes 32 --lights 8 --sensors 4 --latency 0.002
+"""
+import argparse
+import asyncio
+import collections
+import logging
+import os
+import random
+import struct
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from vscp.const import (CLASS_VSCP, CLASS_CONTROL, CLASS_INFORMATION,  # noqa: E402
+                        EVENT_WHO_IS_THERE, EVENT_WHO_IS_THERE_RESPONSE,
+                        EVENT_EXT_PAGE_READ, EVENT_EXT_PAGE_WRITE, EVENT_EXT_PAGE_RESP,
+                        EVENT_INFORMATION_ON, EVENT_INFORMATION_OFF, EVENT_INFORMATION_LEVEL,
+                        EVENT_CONTROL_TURN_ON, EVENT_CONTROL_TURN_OFF, EVENT_CHANGE_LEVEL,
+                        NICKNAME_ALL, DEF_PORT)
+from broker import Broker  # noqa: E402
+from vscp import binary, mqtt  # noqa: E402
+from vscp.event import Event  # noqa: E402
+from vscp.guid import Guid  # noqa: E402
+
+logger = logging.getLogger('uvscpd-sim')
+
+# register layout of the channel blocks, as read by the integration
+REG_TYPE = 0x00
+REG_ENABLE = 0x03
+LI_CAPS = 0x04
+LI_STATE = 0x05
+LI_ZONE = 0x06
+LI_SUBZONE = 0x07
+LI_LEVEL = 0x08
+BS_STATE = 0x04
+BS_CLASS = 0x05
+REG_NAME = 0x10
+
+STD_REG_BASE = 0x80
+STD_REG_STD_DEV = 0x9A
+
+GUID_PREFIX = bytes.fromhex('FFFFFFFFFFFFFFFFFFFFFFFFFFFF00')
+MAX_QUEUE = 10000
+
+
+class SimChannel:
+    def __init__(self, node, index, identifier, zone=0, subzone=0):
+        self.node = node
+        self.index = index
+        self.identifier = identifier
+        self.zone = zone
+        self.subzone = subzone
+
+
+class SimNode:
+    """A level 1 node with VSCP4HASS channels, one channel per page"""
+    def __init__(self, nickname, lights, sensors, zone):
+        self.nickname = nickname
+        self.guid = Guid(GUID_PREFIX + bytes([nickname]))
+        self.mdf = 'sim.vscp/{}.xml'.format(nickname)
+        self.std = bytearray(128)  # registers 0x80-0xFF, identical on every page
+        self.std[STD_REG_STD_DEV - STD_REG_BASE:STD_REG_STD_DEV - STD_REG_BASE + 8] = b'HASS\0\0\0\0'
+        self.pages = collections.defaultdict(lambda: bytearray(128))
+        self.sparse = False  # pages past the end marker are not answered
+        self.channels = []
+        for i in range(lights):
+            self._add_light(zone, i)
+        for i in range(sensors):
+            self._add_sensor(i)
+
+    def _add_light(self, zone, subzone):
+        channel = SimChannel(self, len(self.channels), 'LI', zone, subzone)
+        block = self.pages[channel.index]
+        block[REG_TYPE:REG_TYPE + 2] = b'LI'
+        block[REG_ENABLE] = 1
+        block[LI_CAPS] = 0x09  # brightness + flash
+        block[LI_ZONE] = zone
+        block[LI_SUBZONE] = subzone
+        self._set_name(block, 'light {}.{}'.format(self.nickname, channel.index))
+        self.channels.append(channel)
+
+    def _add_sensor(self, number):
+        channel = SimChannel(self, len(self.channels), 'BS')
+        block = self.pages[channel.index]
+        block[REG_TYPE:REG_TYPE + 2] = b'BS'
+        block[REG_ENABLE] = 1
+        block[BS_CLASS] = 0x0B  # motion
+        self._set_name(block, 'sensor {}.{}'.format(self.nickname, channel.index))
+        self.channels.append(channel)
+
+    @staticmethod
+    def _set_name(block, name):
+        name = name.encode()[:15]
+        block[REG_NAME:REG_NAME + len(name)] = name
+
+    def read(self, page, reg):
+        if reg >= STD_REG_BASE:
+            return self.std[reg - STD_REG_BASE]
+        return self.pages[page][reg] if page in self.pages else 0
+
+    def write(self, page, reg, value):
+        if reg >= STD_REG_BASE:
+            self.std[reg - STD_REG_BASE] = value
+        else:
+            self.pages[page][reg] = value
+
+    def event(self, vscp_class, vscp_type, data):
+        return Event(vscp_class=vscp_class, vscp_type=vscp_type, data=data, head=0x60, guid=self.guid)
+
+    def who_is_there_response(self):
+        raw = bytes(reversed(self.guid.guid_d)) + self.mdf.encode()[:32].ljust(33, b'\0')
+        return [self.event(CLASS_VSCP, EVENT_WHO_IS_THERE_RESPONSE, bytes([i]) + raw[i * 7:i * 7 + 7])
+                for i in range(7)]
+
+    def page_response(self, page, reg, num):
+        if self.sparse and page > len(self.channels) and reg < STD_REG_BASE:
+            return []
+        events = []
+        for index, offset in enumerate(range(0, num, 4)):
+            start = (reg + offset) & 0xFF
+            payload = bytes(self.read(page, (start + i) & 0xFF) for i in range(min(4, num - offset)))
+            events.append(self.event(CLASS_VSCP, EVENT_EXT_PAGE_RESP,
+                                     struct.pack('>BHB', index, page, start) + payload))
+        return events
+
+    def set_light(self, channel, on=None, level=None):
+        """Change a light channel, returns the information events"""
+        block = self.pages[channel.index]
+        events = []
+        if on is not None:
+            block[LI_STATE] = 1 if on else 0
+            events.append(self.event(CLASS_INFORMATION,
+                                     EVENT_INFORMATION_ON if on else EVENT_INFORMATION_OFF,
+                                     bytes([channel.index, channel.zone, channel.subzone])))
+        if level is not None:
+            block[LI_LEVEL] = level
+            events.append(self.event(CLASS_INFORMATION, EVENT_INFORMATION_LEVEL,
+                                     bytes([channel.index, channel.zone, channel.subzone, level])))
+        return events
+
+    def set_sensor(self, channel, on):
+        self.pages[channel.index][BS_STATE] = 1 if on else 0
+        return [self.event(CLASS_INFORMATION, EVENT_INFORMATION_ON if on else EVENT_INFORMATION_OFF,
+                           bytes([channel.index, 0, 0]))]
+
+
+def _passes(event, flt, mask):
+    """VSCP filter semantics: every masked bit has to equal the filter"""
+    (priority, vscp_class, vscp_type, guid) = flt
+    (m_priority, m_class, m_type, m_guid) = mask
+    if ((event.head >> 5) ^ priority) & m_priority:
+        return False
+    if (event.vscp_class ^ vscp_class) & m_class or (event.vscp_type ^ vscp_type) & m_type:
+        return False
+    ev_guid = event.guid.guid_d or bytes(16)
+    return all(((a ^ b) & m) == 0 for a, b, m in zip(ev_guid, guid, m_guid))
+
+
+def _parse_filter(arg):
+    fields = arg.split(',')
+    return (int(fields[0], 0), int(fields[1], 0), int(fields[2], 0),
+            Guid.from_string(fields[3]).guid_d if len(fields) > 3 and fields[3] else bytes(16))
+
+
+class Client:
+    """One daemon connection, text protocol"""
+    def __init__(self, daemon, reader, writer):
+        self.daemon = daemon
+        self.reader = reader
+        self.writer = writer
+        self.queue = collections.deque(maxlen=MAX_QUEUE)
+        self.rcvloop = False
+        self.filter = (0, 0, 0, bytes(16))
+        self.mask = (0, 0, 0, bytes(16))
+        self.task = None
+
+    def deliver(self, event):
+        if not _passes(event, self.filter, self.mask):
+            return
+        if self.rcvloop:
+            self.writer.write(self.encode(event))
+        else:
+            self.queue.append(event)
+
+    def encode(self, event):
+        return repr(event).encode() + b'\r\n'
+
+    def reply(self, *lines):
+        self.writer.write(b''.join(line.encode() + b'\r\n' for line in lines))
+
+    async def run(self):
+        self.reply('Welcome to the uvscpd simulator', '+OK - Success.')
+        try:
+            while True:
+                line = await self.reader.readline()
+                if not line:
+                    break
+                if not self.handle(line.decode().strip()):
+                    break
+                if self.writer.transport.get_write_buffer_size() > 65536:
+                    await self.writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self.daemon.clients.discard(self)
+            self.writer.close()
+
+    def handle(self, line):
+        (cmd, _, arg) = line.partition(' ')
+        cmd = cmd.upper()
+        if cmd in ('NOOP', 'USER', 'PASS'):
+            self.reply('+OK - Success.')
+        elif cmd == 'SEND':
+            try:
+                event = Event.from_string(arg)
+            except Exception:
+                self.reply('-ERR - Invalid event.')
+                return True
+            if self.daemon.send_fault == 'keepalive':
+                self.reply('+OK')
+            elif self.daemon.send_fault is None:
+                self.reply('+OK - Success.')
+            self.daemon.bus_send(event, origin=self)
+        elif cmd == 'RETR':
+            count = int(arg) if arg else 1
+            if not self.queue:
+                self.reply('-ERR - No event(s) available')
+            else:
+                events = [self.queue.popleft() for _ in range(min(count, len(self.queue)))]
+                self.reply(*[repr(ev) for ev in events], '+OK - Success.')
+        elif cmd == 'CDTA':
+            self.reply(str(len(self.queue)), '+OK - Success.')
+        elif cmd == 'CLRA':
+            self.queue.clear()
+            self.reply('+OK - All events cleared.')
+        elif cmd == 'SFLT':
+            self.filter = _parse_filter(arg)
+            self.reply('+OK - Success.')
+        elif cmd == 'SMSK':
+            self.mask = _parse_filter(arg)
+            self.reply('+OK - Success.')
+        elif cmd == 'RCVLOOP':
+            self.reply('+OK - Receive loop entered.')
+            self.rcvloop = True
+            while self.queue:
+                self.writer.write(self.encode(self.queue.popleft()))
+        elif cmd == 'QUITLOOP':
+            self.rcvloop = False
+            self.reply('+OK - Quitted loop.')
+        elif cmd == 'QUIT':
+            self.reply('+OK - Connection closed.')
+            return False
+        else:
+            self.reply('-ERR - Unknown command.')
+        return True
+
+
+class BinaryClient(Client):
+    """One daemon connection, binary framing"""
+    def encode(self, event):
+        return binary.encode_event(event)
+
+    def reply(self, ok=True, message=''):
+        self.writer.write(binary.frame(binary.FRAME_OK if ok else binary.FRAME_ERROR, message.encode()))
+
+    async def run(self):
+        self.reply(message='uvscpd simulator')
+        try:
+            while True:
+                (kind, length) = binary.HEADER.unpack(await self.reader.readexactly(binary.HEADER.size))
+                body = await self.reader.readexactly(length)
+                if not self.handle_frame(kind, body):
+                    break
+                if self.writer.transport.get_write_buffer_size() > 65536:
+                    await self.writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self.daemon.clients.discard(self)
+            self.writer.close()
+
+    def handle_frame(self, kind, body):
+        if kind == binary.FRAME_EVENT:
+            if self.daemon.send_fault is None:
+                self.reply()
+            self.daemon.bus_send(binary.decode_event(body, 0, len(body)), origin=self)
+        elif kind in (binary.FRAME_NOOP, binary.FRAME_USER, binary.FRAME_PASS):
+            self.reply()
+        elif kind in (binary.FRAME_FILTER, binary.FRAME_MASK):
+            value = binary.FILTER.unpack(body)
+            if kind == binary.FRAME_FILTER:
+                self.filter = value
+            else:
+                self.mask = value
+            self.reply()
+        elif kind == binary.FRAME_CLRA:
+            self.queue.clear()
+            self.reply()
+        elif kind == binary.FRAME_RCVLOOP:
+            self.reply()
+            self.rcvloop = True
+            while self.queue:
+                self.writer.write(self.encode(self.queue.popleft()))
+        elif kind == binary.FRAME_QUITLOOP:
+            self.rcvloop = False
+            self.reply()
+        elif kind == binary.FRAME_QUIT:
+            self.reply()
+            return False
+        else:
+            self.reply(False, 'Unknown command')
+        return True
+
+
+CLIENTS = {'text': Client, 'binary': BinaryClient}
+PROTOCOLS = sorted(CLIENTS) + ['mqtt']
+SEND_FAULTS = ('drop', 'keepalive')
+
+
+class Daemon:
+    """The simulated daemon and the segment behind it"""
+    def __init__(self, nodes=8, lights=4, sensors=2, latency=0.001, jitter=0.0, loss=0.0, seed=None,
+                 send_fault=None, sparse_pages=False):
+        self.clients = set()
+        self.nodes = {nickname: SimNode(nickname, lights, sensors, zone=1 + nickname // 16)
+                      for nickname in range(1, nodes + 1)}
+        for node in self.nodes.values():
+            node.sparse = sparse_pages
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self.send_fault = send_fault  # None or one of SEND_FAULTS
+        self.random = random.Random(seed)
+        self.protocol = 'text'
+        self.broker = None
+        self.frames_sent = 0
+        self.frames_lost = 0
+
+    def publish(self, event):
+        """An event appears on the segment, deliver it to all clients"""
+        for client in list(self.clients):
+            client.deliver(event)
+        if self.broker is not None:
+            self.broker.publish(mqtt.event_topic(mqtt.DEF_PREFIX, event), mqtt.event_payload(event))
+
+    def _mqtt_publish(self, topic, payload):
+        """A client published on the broker, the broker already fanned it out"""
+        try:
+            event = binary.decode_event(payload, 0, len(payload))
+        except struct.error:
+            logger.warning('Invalid event payload on %s', topic)
+            return
+        self.bus_send(event, origin=self.broker)
+
+    def node_reply(self, events):
+        """Put node responses on the bus with latency, jitter and loss per frame"""
+        loop = asyncio.get_running_loop()
+        for event in events:
+            if self.random.random() < self.loss:
+                self.frames_lost += 1
+                continue
+            self.frames_sent += 1
+            delay = self.latency + self.random.uniform(0, self.jitter)
+            if delay > 0:
+                loop.call_later(delay, self.publish, event)
+            else:
+                self.publish(event)
+
+    def bus_send(self, event, origin=None):
+        """A client sent an event, other clients see it and the nodes react"""
+        for client in list(self.clients):
+            if client is not origin:
+                client.deliver(event)
+        data = event.data
+        if event.vscp_class == CLASS_VSCP:
+            if event.vscp_type == EVENT_WHO_IS_THERE and data:
+                for node in self.nodes.values():
+                    if data[0] in (node.nickname, NICKNAME_ALL):
+                        self.node_reply(node.who_is_there_response())
+            elif event.vscp_type == EVENT_EXT_PAGE_READ and len(data) >= 5:
+                (nickname, page, reg, num) = struct.unpack('>BHBB', data[:5])
+                if nickname in self.nodes:
+                    self.node_reply(self.nodes[nickname].page_response(page, reg, num or 256))
+            elif event.vscp_type == EVENT_EXT_PAGE_WRITE and len(data) >= 5:
+                (nickname, page, reg) = struct.unpack('>BHB', data[:4])
+                node = self.nodes.get(nickname)
+                if node is not None:
+                    for i, value in enumerate(data[4:]):
+                        node.write(page, (reg + i) & 0xFF, value)
+                    self.node_reply(node.page_response(page, reg, len(data) - 4))
+        elif event.vscp_class == CLASS_CONTROL and len(data) >= 3:
+            self.node_reply(self._control(event.vscp_type, data[0], data[1], data[2]))
+
+    def _control(self, vscp_type, value, zone, subzone):
+        events = []
+        for node in self.nodes.values():
+            for channel in node.channels:
+                if channel.identifier != 'LI':
+                    continue
+                if zone not in (channel.zone, 255) or subzone not in (channel.subzone, 255):
+                    continue
+                if vscp_type == EVENT_CONTROL_TURN_ON:
+                    events.extend(node.set_light(channel, on=True))
+                elif vscp_type == EVENT_CONTROL_TURN_OFF:
+                    events.extend(node.set_light(channel, on=False))
+                elif vscp_type == EVENT_CHANGE_LEVEL:
+                    events.extend(node.set_light(channel, level=value))
+        return events
+
+    async def traffic(self, rate):
+        """Generate on/off/level information events at `rate` events per second"""
+        channels = [ch for node in self.nodes.values() for ch in node.channels]
+        if not channels or rate <= 0:
+            return
+        interval = 1.0 / rate
+        loop = asyncio.get_running_loop()
+        next_time = loop.time()
+        while True:
+            channel = self.random.choice(channels)
+            if channel.identifier == 'LI' and self.random.random() < 0.5:
+                events = channel.node.set_light(channel, level=self.random.randrange(256))
+            elif channel.identifier == 'LI':
+                events = channel.node.set_light(channel, on=self.random.random() < 0.5)
+            else:
+                events = channel.node.set_sensor(channel, self.random.random() < 0.5)
+            for event in events:
+                self.publish(event)
+            next_time += interval * len(events)
+            await asyncio.sleep(max(0, next_time - loop.time()))
+
+    async def _client(self, reader, writer):
+        client = CLIENTS[self.protocol](self, reader, writer)
+        client.task = asyncio.current_task()
+        self.clients.add(client)
+        await client.run()
+
+    async def start(self, host='127.0.0.1', port=DEF_PORT, protocol='text'):
+        self.protocol = protocol
+        if protocol == 'mqtt':
+            self.broker = Broker(on_publish=self._mqtt_publish)
+            port = await self.broker.start(host, port)
+            self.server = self.broker.server
+            return port
+        self.server = await asyncio.start_server(self._client, host, port)
+        return self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        if self.broker is not None:
+            await self.broker.stop()
+            return
+        self.server.close()
+        tasks = [client.task for client in self.clients]
+        for client in list(self.clients):
+            client.writer.close()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await self.server.wait_closed()
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description='uvscpd simulator with VSCP4HASS nodes')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=DEF_PORT)
+    parser.add_argument('--protocol', choices=PROTOCOLS, default='text')
+    parser.add_argument('--nodes', type=int, default=8, help='number of nodes (1-128)')
+    parser.add_argument('--lights', type=int, default=4, help='light channels per node')
+    parser.add_argument('--sensors', type=int, default=2, help='binary sensor channels per node')
+    parser.add_argument('--latency', type=float, default=0.001, help='seconds per response frame')
+    parser.add_argument('--jitter', type=float, default=0.0, help='additional random delay, seconds')
+    parser.add_argument('--loss', type=float, default=0.0, help='probability a response frame is lost')
+    parser.add_argument('--traffic', type=float, default=0.0, help='generated events per second')
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--send-fault', choices=SEND_FAULTS, default=None,
+                        help='lose or mangle the response to SEND')
+    parser.add_argument('--sparse-pages', action='store_true',
+                        help='nodes do not answer pages past their end marker')
+    return parser
+
+
+async def serve(args):
+    daemon = Daemon(nodes=min(max(args.nodes, 0), 128), lights=args.lights, sensors=args.sensors,
+                    latency=args.latency, jitter=args.jitter, loss=args.loss, seed=args.seed,
+                    send_fault=args.send_fault, sparse_pages=args.sparse_pages)
+    port = await daemon.start(args.host, args.port, args.protocol)
+    logger.info('listening on %s:%d with %d nodes', args.host, port, len(daemon.nodes))
+    if args.traffic > 0:
+        asyncio.ensure_future(daemon.traffic(args.traffic))
+    await daemon.server.serve_forever()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    try:
+        asyncio.run(serve(build_parser().parse_args()))
+    except KeyboardInterrupt:
+        pass
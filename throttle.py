@@ -0,0 +1,49 @@
+import asyncio
+
+
+class StateWriter:
+    """Coalesces HASS state writes of an entity.
+
+    The first change after a quiet period is written right away. Further
+    changes within min_interval are merged into a single write at the end of
+    the interval, which always carries the latest state of the entity.
+
+    With metrics set, the end-to-end latency is accounted from the event
+    which started the pending write."""
+    def __init__(self, entity, min_interval, metrics=None):
+        self._entity = entity
+        self._min_interval = min_interval
+        self._metrics = metrics
+        self._last = None  # loop time of the last write
+        self._handle = None
+        self._event = None  # event which caused the pending write
+        self.written = 0
+        self.suppressed = 0
+
+    def schedule(self, event=None):
+        if self._handle is not None:
+            self.suppressed += 1  # merged into the pending write
+            if self._metrics is not None:
+                self._metrics.state_suppressed += 1
+            return
+        self._event = event
+        loop = asyncio.get_running_loop()
+        delay = 0 if self._last is None else self._last + self._min_interval - loop.time()
+        if delay <= 0:
+            self._write()
+        else:
+            self._handle = loop.call_later(delay, self._write)
+
+    def cancel(self):
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+
+    def _write(self):
+        self._handle = None
+        self._last = asyncio.get_running_loop().time()
+        self.written += 1
+        self._entity.async_write_ha_state()
+        if self._metrics is not None:
+            self._metrics.state_written(self._event)
+        self._event = None
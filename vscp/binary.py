@@ -0,0 +1,126 @@
+"""Compact binary framing for the daemon connection.
+
+Every frame starts with a 3 byte header: frame kind (1 byte) and body length
+(2 bytes, big endian). An event body is a fixed 30 byte header followed by
+the raw payload:
+
+    head (2) | class (2) | type (2) | obid (4) | timestamp (4) | GUID (16) | data
+
+Commands from the client are frames without or with a small fixed body, the
+daemon answers every command with an OK or ERROR frame (optionally carrying
+a message). Events from the client are SEND commands and are answered too.
+Filter and mask bodies are: priority (1) | class (2) | type (2) | GUID (16).
+"""
+import struct
+import logging
+from .event import Event
+from .guid import Guid
+from .transport import Transport, ProtoError
+
+logger = logging.getLogger(__name__)
+
+FRAME_EVENT = 0x01
+FRAME_OK = 0x02
+FRAME_ERROR = 0x03
+FRAME_NOOP = 0x10
+FRAME_USER = 0x11
+FRAME_PASS = 0x12
+FRAME_FILTER = 0x13
+FRAME_MASK = 0x14
+FRAME_CLRA = 0x15
+FRAME_RCVLOOP = 0x16
+FRAME_QUITLOOP = 0x17
+FRAME_QUIT = 0x18
+
+COMMANDS = {'NOOP': FRAME_NOOP, 'USER': FRAME_USER, 'PASS': FRAME_PASS,
+            'SFLT': FRAME_FILTER, 'SMSK': FRAME_MASK, 'CLRA': FRAME_CLRA,
+            'RCVLOOP': FRAME_RCVLOOP, 'QUITLOOP': FRAME_QUITLOOP, 'QUIT': FRAME_QUIT,
+            'SEND': FRAME_EVENT}
+
+HEADER = struct.Struct('>BH')
+EVENT_HEADER = struct.Struct('>HHHII16s')
+FILTER = struct.Struct('>BHH16s')
+
+_EMPTY_GUID = bytes(16)
+
+
+def frame(kind, body=b''):
+    return HEADER.pack(kind, len(body)) + body
+
+
+def encode_event(event):
+    """Return the event frame of an event"""
+    data = event.data
+    return HEADER.pack(FRAME_EVENT, EVENT_HEADER.size + len(data)) + \
+        EVENT_HEADER.pack(event.head, event.vscp_class, event.vscp_type, event.obid,
+                          event.timestamp & 0xFFFFFFFF, event.guid.guid_d or _EMPTY_GUID) + data
+
+
+def decode_event(buffer, start, end):
+    """Decode the event frame body at buffer[start:end]"""
+    (head, vscp_class, vscp_type, obid, timestamp, guid) = EVENT_HEADER.unpack_from(buffer, start)
+    return Event.from_fields(head, vscp_class, vscp_type, obid, timestamp, Guid(guid),
+                             bytes(buffer[start + EVENT_HEADER.size:end]))
+
+
+def encode_filter(kind, priority, vscp_class, vscp_type, guid):
+    return frame(kind, FILTER.pack(priority, vscp_class, vscp_type, guid.guid_d or _EMPTY_GUID))
+
+
+def split_frames(buffer):
+    """Return a list of (kind, body start, body end) for all complete frames
+       in buffer and the offset of the first incomplete one"""
+    frames = []
+    offset = 0
+    size = len(buffer)
+    while offset + HEADER.size <= size:
+        (kind, length) = HEADER.unpack_from(buffer, offset)
+        end = offset + HEADER.size + length
+        if end > size:
+            break
+        frames.append((kind, offset + HEADER.size, end))
+        offset = end
+    return frames, offset
+
+
+class BinaryTCP(Transport):
+    """Connection to a daemon speaking the binary framing"""
+    async def _handshake(self):
+        self._welcome = await self._read_response()
+        await self.login()
+
+    def _encode_command(self, verb, arg=None):
+        kind = COMMANDS[verb]
+        if kind == FRAME_EVENT:
+            return encode_event(arg)
+        if kind == FRAME_FILTER:
+            return encode_filter(kind, arg.priority, arg.event_class, arg.type, arg.guid)
+        if kind == FRAME_MASK:
+            return encode_filter(kind, arg.mask_priority, arg.mask_class, arg.mask_type, arg.mask_guid)
+        return frame(kind, b'' if arg is None else str(arg).encode())
+
+    def _encode_event(self, event):
+        return encode_event(event)
+
+    async def _read_response(self):
+        (kind, length) = HEADER.unpack(await self._reader.readexactly(HEADER.size))
+        body = await self._reader.readexactly(length)
+        if kind != FRAME_OK:
+            raise ProtoError(body)
+        return body
+
+    def getwelcome(self):
+        return self._welcome
+
+    def _decode(self, buffer):
+        (frames, offset) = split_frames(buffer)
+        view = memoryview(buffer)
+        events = []
+        for (kind, start, end) in frames:
+            if kind == FRAME_EVENT:
+                events.append(decode_event(view, start, end))
+            elif kind == FRAME_OK or kind == FRAME_ERROR:
+                self._response(kind == FRAME_OK, bytes(view[start:end]))
+            else:
+                logger.warning('Unexpected frame kind %d from the daemon', kind)
+        return (events, bytes(view[offset:]))
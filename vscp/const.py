@@ -3,6 +3,8 @@ DEF_PORT = 8598
 DEF_USER = None
 DEF_PASSWORD = None
 
+NICKNAME_ALL = 0xFF
+
 CLASS_VSCP = 0
 CLASS_INFORMATION = 0x14
 CLASS_CONTROL = 0x1E
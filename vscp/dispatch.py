@@ -0,0 +1,136 @@
+import logging
+
+logger = logging.getLogger(__name__)
+
+# wildcard value for subscription keys
+ANY = None
+
+
+class _Index:
+    """Callbacks per 4-field key, fields set to ANY match every value.
+
+    Keys are stored with ANY in the wildcard positions, and the index keeps
+    track of which wildcard patterns are in use. A lookup costs one dict
+    access per pattern in use (at most 16), independent of the number of
+    subscriptions."""
+    def __init__(self, on_change=None):
+        self._table = dict()  # key -> list of callbacks
+        self._patterns = dict()  # tuple of wildcard positions -> number of keys
+        self._on_change = on_change  # called when a key is added or removed
+
+    def add(self, key, callback):
+        callbacks = self._table.get(key)
+        if callbacks is None:
+            callbacks = self._table[key] = []
+            pattern = tuple(i for i, field in enumerate(key) if field is ANY)
+            self._patterns[pattern] = self._patterns.get(pattern, 0) + 1
+            if self._on_change is not None:
+                self._on_change()
+        callbacks.append(callback)
+
+    def remove(self, key, callback):
+        callbacks = self._table.get(key)
+        if callbacks is None or callback not in callbacks:
+            return
+        callbacks.remove(callback)
+        if not callbacks:
+            del self._table[key]
+            pattern = tuple(i for i, field in enumerate(key) if field is ANY)
+            self._patterns[pattern] -= 1
+            if self._patterns[pattern] == 0:
+                del self._patterns[pattern]
+            if self._on_change is not None:
+                self._on_change()
+
+    def keys(self):
+        return self._table.keys()
+
+    def match(self, key):
+        """Return the callbacks subscribed to a key"""
+        matched = []
+        for pattern in self._patterns:
+            if pattern:
+                lookup = list(key)
+                for i in pattern:
+                    lookup[i] = ANY
+                callbacks = self._table.get(tuple(lookup))
+            else:
+                callbacks = self._table.get(key)
+            if callbacks:
+                matched.extend(callbacks)
+        return matched
+
+
+class Subscription:
+    """Handle returned for every subscription"""
+    __slots__ = ('_index', '_key', '_callback')
+
+    def __init__(self, index, key, callback):
+        self._index = index
+        self._key = key
+        self._callback = callback
+
+    def unsubscribe(self):
+        if self._index is not None:
+            self._index.remove(self._key, self._callback)
+            self._index = None
+
+
+class Dispatcher:
+    """Routes received events to subscribed callbacks.
+
+    Channel subscriptions match on the node nickname and the channel index
+    in data byte 0. Zone subscriptions match on zone and subzone in data
+    bytes 1 and 2. Class and type can be ANY for both, zone and subzone can
+    be ANY for zone subscriptions. A key can have any number of
+    subscribers.
+
+    on_change is called whenever the set of subscribed keys changes."""
+    def __init__(self, on_change=None):
+        self._channels = _Index(on_change)  # key = (nickname, index, class, type)
+        self._zones = _Index(on_change)  # key = (zone, subzone, class, type)
+
+    def subscribe_channel(self, nickname, index, vscp_class, vscp_type, callback):
+        key = (nickname, index, vscp_class, vscp_type)
+        self._channels.add(key, callback)
+        return Subscription(self._channels, key, callback)
+
+    def subscribe_zone(self, zone, subzone, vscp_class, vscp_type, callback):
+        key = (zone, subzone, vscp_class, vscp_type)
+        self._zones.add(key, callback)
+        return Subscription(self._zones, key, callback)
+
+    def channel_keys(self):
+        return self._channels.keys()
+
+    def zone_keys(self):
+        return self._zones.keys()
+
+    def patterns(self):
+        """Return the (class, type, nickname) patterns of all subscriptions,
+           ANY where a field matches any value"""
+        patterns = {(key[2], key[3], key[0]) for key in self._channels.keys()}
+        patterns.update((key[2], key[3], ANY) for key in self._zones.keys())
+        return patterns
+
+    def match(self, event):
+        """Return all callbacks for an event"""
+        data = event.data
+        if not data:
+            return []
+        callbacks = self._channels.match((event.guid.nickname, data[0], event.vscp_class, event.vscp_type))
+        if len(data) >= 3:
+            callbacks.extend(self._zones.match((data[1], data[2], event.vscp_class, event.vscp_type)))
+        return callbacks
+
+    async def dispatch(self, event):
+        await self.dispatch_batch((event,))
+
+    async def dispatch_batch(self, events):
+        """Dispatch a list of events in order"""
+        for event in events:
+            for callback in self.match(event):
+                try:
+                    await callback(event)
+                except Exception:
+                    logger.exception('Unhandled exception in event callback')
@@ -1,19 +1,49 @@
 import datetime
-import dateutil.parser
 from .guid import Guid
 
+_UTC = datetime.timezone.utc
+
+# one entry cache, consecutive events mostly share the same timestamp
+_last_dt = (None, None)
+
+def _parse_datetime(value):
+    """Parse the fixed uvscpd layout YYYY-MM-DDTHH:MM:SS[.ffffff][Z]"""
+    global _last_dt
+    if value == _last_dt[0]:
+        return _last_dt[1]
+    if value.endswith('Z'):
+        dt = datetime.datetime.fromisoformat(value[:-1]).replace(tzinfo=_UTC)
+    else:
+        dt = datetime.datetime.fromisoformat(value)
+    _last_dt = (value, dt)
+    return dt
+
+def _parse_datetime_generic(value):
+    import dateutil.parser
+    return dateutil.parser.parse(value)
+
 class Event:
-    def __init__(self, vscp_class=0, vscp_type=0, data=bytearray(), obid=0,
-            timestamp=0, head=0,dt=datetime.datetime.utcnow(),guid=Guid()):
+    """A VSCP event.
+
+    The payload is stored as immutable bytes. Events parsed from the
+    daemon keep the raw date/time string, `dt` is only decoded when it is
+    accessed."""
+    __slots__ = ('timestamp', 'head', '_dt', '_dt_raw', 'guid', 'vscp_class',
+                 'vscp_type', 'data', 'obid', '_encoded')
+
+    def __init__(self, vscp_class=0, vscp_type=0, data=b'', obid=0,
+            timestamp=0, head=0, dt=None, guid=Guid()):
         self.timestamp = timestamp
         self.head = head
-        self.dt = dt
+        self._dt = dt
+        self._dt_raw = None
         self.guid = guid
         self.vscp_class = vscp_class
         self.vscp_type = vscp_type
-        self.data = bytearray(data)
+        self.data = bytes(data)
         self.obid = obid
-        if not isinstance(self.dt, datetime.datetime):
+        self._encoded = None
+        if dt is not None and not isinstance(dt, datetime.datetime):
             raise ValueError('invalid date/time')
         if self.vscp_class > 0xffff or self.vscp_class < 0:
             raise ValueError('invalid vscp_class')
@@ -22,6 +52,24 @@ class Event:
         if not len(self.data)<64:
             raise ValueError('data too long')
 
+    @property
+    def dt(self):
+        if self._dt is None:
+            if self._dt_raw is None:
+                self._dt = datetime.datetime.utcnow()
+            else:
+                try:
+                    self._dt = _parse_datetime(self._dt_raw)
+                except ValueError:
+                    self._dt = _parse_datetime_generic(self._dt_raw)
+        return self._dt
+
+    @dt.setter
+    def dt(self, value):
+        if not isinstance(value, datetime.datetime):
+            raise ValueError('invalid date/time')
+        self._dt = value
+
     def __repr__(self):
         repr = f'{self.head},{self.vscp_class},{self.vscp_type},' \
                f'{self.obid},{self.dt.replace(microsecond=0).isoformat()},' \
@@ -30,14 +78,80 @@ class Event:
             repr += f',{",".join([str(b) for b in self.data])}'
         return repr
 
+    def encode(self):
+        """Return the text representation as bytes. The result is cached,
+           so an event should not be modified once it has been sent."""
+        if self._encoded is None:
+            self._encoded = repr(self).encode()
+        return self._encoded
+
+    def with_priority(self, priority):
+        """Return the event with VSCP priority (0-7) in the head. The event
+           is copied unless it has that priority already, it is never
+           modified."""
+        head = (self.head & ~0xE0) | (priority << 5)
+        if head == self.head:
+            return self
+        event = Event(self.vscp_class, self.vscp_type, self.data, self.obid,
+                      self.timestamp, head, self._dt, self.guid)
+        event._dt_raw = self._dt_raw
+        return event
+
+    @classmethod
+    def from_string(cls, input):
+        """Parse an event line, falls back to the generic parser for
+           anything not in the layout uvscpd sends"""
+        try:
+            return cls._from_string_fast(input)
+        except (ValueError, IndexError):
+            return cls._from_string_generic(input)
+
+    @classmethod
+    def _from_string_fast(cls, input):
+        ev = input.rstrip().split(',')
+        if len(ev) < 7:
+            raise ValueError('not enough fields')
+        self = object.__new__(cls)
+        self.head = int(ev[0])
+        self.vscp_class = int(ev[1])
+        self.vscp_type = int(ev[2])
+        self.obid = int(ev[3])
+        self._dt = None
+        self._dt_raw = ev[4]
+        self._encoded = None
+        self.timestamp = int(ev[5])
+        self.guid = Guid.from_string(ev[6])
+        self.data = bytes(map(int, ev[7:]))
+        if self.vscp_class > 0xffff or self.vscp_class < 0 or self.vscp_type > 511 \
+                or self.vscp_type < 0 or len(self.data) >= 64:
+            raise ValueError('invalid event')
+        return self
+
+    @classmethod
+    def from_fields(cls, head, vscp_class, vscp_type, obid, timestamp, guid, data):
+        """Build an event from already decoded fields (binary framing),
+           without validation. data has to be bytes."""
+        self = object.__new__(cls)
+        self.head = head
+        self.vscp_class = vscp_class
+        self.vscp_type = vscp_type
+        self.obid = obid
+        self._dt = None
+        self._dt_raw = None
+        self._encoded = None
+        self.timestamp = timestamp
+        self.guid = guid
+        self.data = data
+        return self
+
     @classmethod
-    def from_string(cls,input):
+    def _from_string_generic(cls, input):
         ev = input.split(',')
         head = int(ev[0],base=0)
         vscp_class = int(ev[1],base=0)
         vscp_type = int(ev[2],base=0)
         obid = int(ev[3],base=0)
-        dt = dateutil.parser.parse(ev[4])
+        dt = _parse_datetime_generic(ev[4])
         timestamp = int(ev[5])
         guid_l = Guid.from_string(ev[6])
         data = bytearray(len(ev)-7)
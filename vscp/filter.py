@@ -1,5 +1,19 @@
 from .guid import Guid
 
+
+def _common_bits(values, width):
+    """Return (value, mask) for the bits all values have in common.
+       A None value matches anything and clears the mask."""
+    if not values or None in values:
+        return 0, 0
+    values = list(values)
+    diff = 0
+    for value in values:
+        diff |= value ^ values[0]
+    mask = width & ~diff
+    return values[0] & mask, mask
+
+
 class Filter():
     def __init__(self, priority, mask_priority, event_class, mask_class,
                  type, mask_type, guid=Guid.clear(), mask_guid=Guid.clear()):
@@ -28,7 +42,22 @@ class Filter():
 
     @classmethod
     def clear(cls):
-        return cls(0, 0x7, 0, 0xffff, 0, 0x1FF, guid.clear(), guid.set())
+        return cls(0, 0x7, 0, 0xffff, 0, 0x1FF, Guid.clear(), Guid.set())
+
+    @classmethod
+    def covering(cls, patterns):
+        """Return the tightest filter passing all (class, type, nickname)
+           patterns, None fields match any value.
+
+        A daemon connection holds a single filter/mask pair, so the result
+        passes every event that agrees with the patterns on the bits they
+        all have in common."""
+        patterns = list(patterns)
+        (event_class, mask_class) = _common_bits({p[0] for p in patterns}, 0x3ff)
+        (event_type, mask_type) = _common_bits({p[1] for p in patterns}, 0xff)
+        (nickname, mask_nickname) = _common_bits({p[2] for p in patterns}, 0xff)
+        return cls(0, 0, event_class, mask_class, event_type, mask_type,
+                   Guid(bytes(15) + bytes([nickname])), Guid(bytes(15) + bytes([mask_nickname])))
 
     def filter_str(self):
         return f'{self.priority},{self.event_class},{self.type},{self.guid}'
@@ -1,52 +1,93 @@
+# upper bound for the intern tables, a segment holds at most 256 nodes
+_MAX_INTERNED = 1024
+
+
 class Guid:
-    def __init__(self, input=None):
-        if input == None:
-            self.guid_d = None
-            return
+    """Immutable VSCP GUID.
+
+    Instances are interned: every GUID value (in practice one per node) is
+    backed by a single object, its string form is built once and cached."""
+    __slots__ = ('guid_d', '_str')
+
+    _interned = dict()  # key = 16 bytes
+    _by_str = dict()  # key = string as received
+
+    def __new__(cls, input=None):
+        if input is None:
+            return _EMPTY
         if not isinstance(input, (bytearray, bytes)):
             raise ValueError('input has to be bytearray or bytes')
         if len(input) != 16:
             raise ValueError('input has to be 16 bytes')
-        self.guid_d = bytearray(input)
+        key = bytes(input)
+        self = cls._interned.get(key)
+        if self is None:
+            self = object.__new__(cls)
+            object.__setattr__(self, 'guid_d', key)
+            object.__setattr__(self, '_str', None)
+            if len(cls._interned) >= _MAX_INTERNED:
+                cls._interned.clear()
+            cls._interned[key] = self
+        return self
+
+    def __setattr__(self, name, value):
+        raise AttributeError('Guid is immutable')
 
     def __repr__(self):
-        if self.guid_d == None:
-            return ''
-        else:
-            sa = [format("%02X" % a) for a in self.guid_d]
-            return ( ":" . join(sa))
+        if self._str is None:
+            if self.guid_d is None:
+                text = ''
+            else:
+                text = self.guid_d.hex(':').upper()
+            object.__setattr__(self, '_str', text)
+        return self._str
+
+    def __eq__(self, other):
+        if not isinstance(other, Guid):
+            return NotImplemented
+        return self.guid_d == other.guid_d
+
+    def __hash__(self):
+        return hash(self.guid_d)
+
+    def __reduce__(self):
+        return (Guid, (self.guid_d,))
 
     @classmethod
     def valid(cls, inst):
         if not isinstance(inst, Guid):
             raise ValueError('not a guid class')
-        if len(inst.guid_d) != 16:
+        if inst.guid_d is None or len(inst.guid_d) != 16:
             raise ValueError('guid has to be 16 bytes')
 
     @classmethod
     def from_string(cls, guidstr):
         if guidstr == '':
-            return cls()
-        else:
-            return cls(bytes(int(z,16) for z in guidstr.split(':')))
+            return _EMPTY
+        self = cls._by_str.get(guidstr)
+        if self is None:
+            self = cls(bytes.fromhex(guidstr.replace(':', '')))
+            if len(cls._by_str) >= _MAX_INTERNED:
+                cls._by_str.clear()
+            cls._by_str[guidstr] = self
+        return self
 
     @classmethod
     def clear(cls):
-        return cls(bytearray(16))
+        return cls(bytes(16))
 
     @classmethod
     def set(cls):
-        return cls(bytearray(b'/xFF')*16)
+        return cls(b'\xFF' * 16)
 
     @property
     def nickname(self):
-        if self.guid_d == None:
+        if self.guid_d is None:
             return None
         else:
             return self.guid_d[15]
 
-    @nickname.setter
-    def nickname(self, value):
-        if value > 255 or value < 0:
-            raise ValueError
-        self.guid_d[15] = value
+
+_EMPTY = object.__new__(Guid)
+object.__setattr__(_EMPTY, 'guid_d', None)
+object.__setattr__(_EMPTY, '_str', None)
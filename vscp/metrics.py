@@ -0,0 +1,191 @@
+import bisect
+import time
+
+# histogram bounds in seconds, roughly logarithmic from 10us to 10s
+LATENCY_BOUNDS = (1e-5, 2e-5, 5e-5, 1e-4, 2e-4, 5e-4, 1e-3, 2e-3, 5e-3,
+                  0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0, 5.0, 10.0)
+
+# histogram bounds for queue depths
+DEPTH_BOUNDS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+# a node clock offset moving up by more than this is taken as a timestamp
+# wrap or a node restart, the offset is estimated again
+_MAX_OFFSET_JUMP = 60.0
+
+
+class Histogram:
+    """Fixed bucket histogram, an observation costs a bisect"""
+    def __init__(self, bounds=LATENCY_BOUNDS):
+        self.bounds = bounds
+        self.buckets = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value, count=1):
+        """Add value, count times (used for per-event averages of a batch)"""
+        self.buckets[bisect.bisect_left(self.bounds, value)] += count
+        self.count += count
+        self.total += value * count
+        if value > self.max:
+            self.max = value
+
+    def copy(self):
+        other = Histogram(self.bounds)
+        other.buckets = list(self.buckets)
+        other.count = self.count
+        other.total = self.total
+        other.max = self.max
+        return other
+
+    def delta(self, previous):
+        """Return the observations made since previous, a copy of this
+           histogram. max is kept over the whole lifetime."""
+        other = self.copy()
+        if previous is not None:
+            other.buckets = [a - b for a, b in zip(self.buckets, previous.buckets)]
+            other.count -= previous.count
+            other.total -= previous.total
+        return other
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else None
+
+    def percentile(self, q):
+        """Upper bound of the bucket holding the q-th quantile (0 < q <= 1)"""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if seen >= rank:
+                return self.bounds[i] if i < len(self.bounds) else self.max
+        return self.max
+
+    def as_dict(self):
+        return {'count': self.count,
+                'mean': self.mean,
+                'p50': self.percentile(0.5),
+                'p95': self.percentile(0.95),
+                'p99': self.percentile(0.99),
+                'max': self.max,
+                'buckets': {str(bound): n for bound, n in
+                            zip(list(self.bounds) + ['inf'], self.buckets) if n}}
+
+
+class RateCounter:
+    """Counters per key. Rates are computed over the time between two calls
+       of rates(), at least window seconds apart."""
+    def __init__(self, window=10.0):
+        self.totals = dict()
+        self._window = window
+        self._since = time.monotonic()
+        self._snapshot = dict()
+        self._rates = dict()
+
+    def add(self, key, count=1):
+        self.totals[key] = self.totals.get(key, 0) + count
+
+    def rates(self):
+        now = time.monotonic()
+        elapsed = now - self._since
+        if elapsed >= self._window:
+            self._rates = {key: (total - self._snapshot.get(key, 0)) / elapsed
+                           for key, total in self.totals.items()}
+            self._snapshot = dict(self.totals)
+            self._since = now
+        return self._rates
+
+    def rate(self):
+        return sum(self.rates().values())
+
+    def total(self):
+        return sum(self.totals.values())
+
+
+class Metrics:
+    """Runtime metrics of one or more connections to the daemon.
+
+    End-to-end latency runs from the node timestamp of an event to the state
+    write it caused. Node clocks are not synchronised with the host, so the
+    offset per node is estimated as the smallest (receive time - timestamp)
+    seen: the result is the latency on top of the fastest delivery observed."""
+    def __init__(self):
+        self.commands = dict()  # command verb -> Histogram of round trips
+        self.command_rtt = Histogram()
+        self.received = RateCounter()  # key = (class, type)
+        self.sent = RateCounter()
+        self.parse_time = Histogram()  # per event
+        self.dispatch_time = Histogram()  # per event
+        self.outbox_depth = Histogram(DEPTH_BOUNDS)  # sampled when events are queued
+        self.read_latency = Histogram()
+        self.read_retries = 0
+        self.read_timeouts = 0
+        self.end_to_end = Histogram()
+        self.state_writes = 0
+        self.state_suppressed = 0
+        self.admission_wait = dict()  # traffic class -> Histogram of waits for admission
+        self._offsets = dict()  # nickname -> estimated clock offset
+
+    def command(self, verb, seconds):
+        histogram = self.commands.get(verb)
+        if histogram is None:
+            histogram = self.commands[verb] = Histogram()
+        histogram.observe(seconds)
+        self.command_rtt.observe(seconds)
+
+    def received_batch(self, events, parse_time):
+        """Account a batch of received events, parse_time for the whole batch"""
+        now = time.monotonic()
+        offsets = self._offsets
+        for event in events:
+            self.received.add((event.vscp_class, event.vscp_type))
+            nickname = event.guid.nickname
+            offset = now - event.timestamp * 1e-6
+            previous = offsets.get(nickname)
+            if previous is None or offset < previous or offset - previous > _MAX_OFFSET_JUMP:
+                offsets[nickname] = offset
+        self.parse_time.observe(parse_time / len(events), len(events))
+
+    def admission(self, traffic, seconds):
+        histogram = self.admission_wait.get(traffic)
+        if histogram is None:
+            histogram = self.admission_wait[traffic] = Histogram()
+        histogram.observe(seconds)
+
+    def dispatched_batch(self, count, dispatch_time):
+        self.dispatch_time.observe(dispatch_time / count, count)
+
+    def sent_events(self, events):
+        for event in events:
+            self.sent.add((event.vscp_class, event.vscp_type))
+
+    def state_written(self, event):
+        """A state write caused by event, None if there is no such event"""
+        self.state_writes += 1
+        if event is None:
+            return
+        offset = self._offsets.get(event.guid.nickname)
+        if offset is not None:
+            self.end_to_end.observe(max(time.monotonic() - offset - event.timestamp * 1e-6, 0))
+
+    def as_dict(self):
+        return {'commands': {verb: h.as_dict() for verb, h in self.commands.items()},
+                'received': {'rate': self.received.rate(),
+                             'total': self.received.total(),
+                             'by_class_type': {'{},{}'.format(*key): n for key, n in self.received.totals.items()}},
+                'sent': {'rate': self.sent.rate(),
+                         'total': self.sent.total(),
+                         'by_class_type': {'{},{}'.format(*key): n for key, n in self.sent.totals.items()}},
+                'parse_time': self.parse_time.as_dict(),
+                'dispatch_time': self.dispatch_time.as_dict(),
+                'outbox_depth': self.outbox_depth.as_dict(),
+                'read_latency': self.read_latency.as_dict(),
+                'read_retries': self.read_retries,
+                'read_timeouts': self.read_timeouts,
+                'end_to_end': self.end_to_end.as_dict(),
+                'state_writes': self.state_writes,
+                'state_suppressed': self.state_suppressed,
+                'admission_wait': {traffic: h.as_dict() for traffic, h in self.admission_wait.items()}}
@@ -0,0 +1,380 @@
+"""MQTT transport, the event stream goes through a broker instead of a daemon.
+
+Events are published on the topic <prefix>/<GUID>/<class>/<type>, the payload
+is the event body of the binary framing (see vscp.binary): a fixed 30 byte
+header followed by the data. Subscriptions are made per class and type, so
+the broker only forwards events somebody is interested in. Events without
+confirmation are published with QoS 0 and written out in batches, confirmed
+ones with QoS 1 and acknowledged by the broker.
+
+Only the parts of MQTT 3.1.1 used by a client with a clean session are
+implemented: CONNECT, SUBSCRIBE, UNSUBSCRIBE, PUBLISH (QoS 0/1), PINGREQ and
+DISCONNECT.
+
+The client is kept here instead of going through Home Assistant's mqtt
+integration or a client library: the vscp package has no dependencies beyond
+the standard library and is used by the simulator and benchmarks outside of
+Home Assistant, and the gateway needs the same Transport interface (command
+pipelining, the in-flight watchdog, reconnect on a lost connection) as the
+daemon protocols. Anything beyond the subset above (QoS 2, retained
+messages, persistent sessions, TLS) belongs in such a library rather than
+here.
+"""
+import asyncio
+import itertools
+import logging
+import secrets
+import struct
+import time
+from .binary import EVENT_HEADER, decode_event, _EMPTY_GUID
+from .dispatch import ANY
+from .transport import Transport, ProtoError, RcvloopError, CredError, ResponseTimeout
+
+logger = logging.getLogger(__name__)
+
+DEF_PREFIX = 'vscp'
+
+# packet types, shifted into the upper nibble of the first byte
+CONNECT = 0x10
+CONNACK = 0x20
+PUBLISH = 0x30
+PUBACK = 0x40
+SUBSCRIBE = 0x82
+SUBACK = 0x90
+UNSUBSCRIBE = 0xA2
+UNSUBACK = 0xB0
+PINGREQ = 0xC0
+PINGRESP = 0xD0
+DISCONNECT = 0xE0
+
+# seconds of silence after which the broker drops the client, pings are sent
+# at half this interval
+_MQTT_KEEPALIVE = 60
+
+# largest packet accepted from the broker
+_MAX_PACKET = 1 << 20
+
+_PID = struct.Struct('>H')
+
+
+def _length(value):
+    """Encode a remaining length"""
+    out = bytearray()
+    while True:
+        (value, byte) = divmod(value, 128)
+        out.append(byte | 0x80 if value else byte)
+        if not value:
+            return bytes(out)
+
+
+def _string(text):
+    data = text.encode()
+    return _PID.pack(len(data)) + data
+
+
+def packet(kind, body=b''):
+    return bytes([kind]) + _length(len(body)) + body
+
+
+def publish_packet(topic, payload, qos=0, pid=None):
+    body = _string(topic)
+    if qos:
+        body += _PID.pack(pid)
+    return packet(PUBLISH | qos << 1, body + payload)
+
+
+def split_packets(buffer):
+    """Return a list of (first byte, body start, body end) for all complete
+       packets in buffer and the offset of the first incomplete one"""
+    packets = []
+    offset = 0
+    size = len(buffer)
+    while offset + 2 <= size:
+        length = 0
+        shift = 0
+        pos = offset + 1
+        while pos < size and pos - offset <= 4:
+            byte = buffer[pos]
+            length |= (byte & 0x7F) << shift
+            shift += 7
+            pos += 1
+            if not byte & 0x80:
+                break
+        else:
+            if pos - offset > 4:
+                raise ProtoError('Invalid packet length')
+            break  # length incomplete
+        if length > _MAX_PACKET:
+            raise ProtoError('Packet of {} bytes from the broker'.format(length))
+        if pos + length > size:
+            break
+        packets.append((buffer[offset], pos, pos + length))
+        offset = pos + length
+    return packets, offset
+
+
+def topic_match(subscription, topic):
+    """True if a topic matches a subscription with + and # wildcards"""
+    sub = subscription.split('/')
+    levels = topic.split('/')
+    for i, level in enumerate(sub):
+        if level == '#':
+            return True
+        if i >= len(levels) or (level != '+' and level != levels[i]):
+            return False
+    return len(sub) == len(levels)
+
+
+def event_topic(prefix, event):
+    guid = event.guid.guid_d or _EMPTY_GUID
+    return '{}/{}/{}/{}'.format(prefix, guid.hex(':').upper(), event.vscp_class, event.vscp_type)
+
+
+def event_payload(event):
+    return EVENT_HEADER.pack(event.head, event.vscp_class, event.vscp_type, event.obid,
+                             event.timestamp & 0xFFFFFFFF, event.guid.guid_d or _EMPTY_GUID) + event.data
+
+
+def pattern_topics(prefix, patterns):
+    """Return the topic subscriptions for (class, type, nickname) patterns.
+
+    The nickname is part of the GUID level and can't be selected by a topic,
+    those events are sorted out by the dispatcher."""
+    pairs = {(vscp_class, vscp_type) for (vscp_class, vscp_type, _) in patterns}
+    if (ANY, ANY) in pairs:
+        pairs = {(ANY, ANY)}
+    # drop pairs covered by a wildcard pair
+    pairs = {(c, t) for (c, t) in pairs
+             if not ((t is not ANY and (c, ANY) in pairs) or (c is not ANY and (ANY, t) in pairs))}
+    return sorted('{}/+/{}/{}'.format(prefix, '+' if c is ANY else c, '+' if t is ANY else t)
+                  for (c, t) in pairs)
+
+
+class MQTT(Transport):
+    """Connection to an MQTT broker carrying the VSCP events of a segment.
+
+    Without client_id a random one is made, starting with client_name, so
+    several clients can share the broker."""
+    def __init__(self, *args, prefix=DEF_PREFIX, client_id=None, client_name='vscp', **kwargs):
+        super().__init__(*args, **kwargs)
+        self._prefix = prefix
+        self._client_id = client_id or '{}-{}'.format(client_name, secrets.token_hex(6))
+        self._topics = set()
+        self._pids = itertools.cycle(range(1, 0x10000))
+        self._acks = dict()  # (packet type, packet id) -> (future, verb, start, holds window slot)
+        self._ping_task = None
+
+    async def _handshake(self):
+        flags = 0x02  # clean session
+        payload = _string(self._client_id)
+        if self._user is not None:
+            flags |= 0x80
+            payload += _string(self._user)
+        if self._password is not None:
+            flags |= 0x40
+            payload += _string(self._password)
+        await self._putcmd(packet(CONNECT, _string('MQTT') + bytes([4, flags]) +
+                                  _PID.pack(_MQTT_KEEPALIVE) + payload))
+        (kind, body) = await self._read_packet()
+        if kind != CONNACK or len(body) != 2:
+            raise ProtoError('Expected CONNACK, got {!r}'.format(kind))
+        if body[1] in (4, 5):
+            raise CredError('Broker refused the credentials')
+        if body[1] != 0:
+            raise ProtoError('Broker refused the connection ({})'.format(body[1]))
+        self._welcome = body
+
+    def getwelcome(self):
+        return self._welcome
+
+    async def _read_packet(self):
+        header = await self._reader.readexactly(1)
+        length = 0
+        for shift in range(0, 28, 7):
+            byte = (await self._reader.readexactly(1))[0]
+            length |= (byte & 0x7F) << shift
+            if not byte & 0x80:
+                break
+        return header[0] & 0xF0, await self._reader.readexactly(length)
+
+    def _next_pid(self):
+        for pid in self._pids:
+            if (PUBACK, pid) not in self._acks and (SUBACK, pid) not in self._acks \
+                    and (UNSUBACK, pid) not in self._acks:
+                return pid
+
+    def _expect(self, kind, pid, verb, slot=False):
+        future = asyncio.get_running_loop().create_future()
+        self._acks[(kind, pid)] = (future, verb, time.perf_counter(), slot)
+        return future
+
+    def _acknowledged(self, kind, pid, body):
+        entry = self._acks.pop((kind, pid), None)
+        if entry is None:
+            logger.debug('Unexpected acknowledge %x for packet %s', kind, pid)
+            return
+        (future, verb, start, slot) = entry
+        if slot:
+            self._window.release()
+        if self.metrics is not None:
+            self.metrics.command(verb, time.perf_counter() - start)
+        if future.done():
+            return
+        if kind == SUBACK and 0x80 in body:
+            future.set_exception(ProtoError('Broker refused a subscription'))
+        else:
+            future.set_result(body)
+
+    async def _request(self, data, kind, pid, verb):
+        """Write a packet and wait for its acknowledge, in the receive loop
+           it is matched by the receive task"""
+        if self._rcvloop:
+            future = self._expect(kind, pid, verb)
+            await self._putcmd(data)
+            return await self._confirmed(future)
+        start = time.perf_counter()
+        await self._putcmd(data)
+        while True:
+            (received, body) = await self._read_packet()
+            if received == kind and (pid is None or _PID.unpack_from(body)[0] == pid):
+                break  # events received before the receive loop are dropped
+        if self.metrics is not None:
+            self.metrics.command(verb, time.perf_counter() - start)
+        return body
+
+    def _encode_event(self, event):
+        return publish_packet(event_topic(self._prefix, event), event_payload(event))
+
+    async def _prepare_event(self, event, confirm):
+        """QoS 0 without confirm, QoS 1 and a window slot with confirm"""
+        if not confirm:
+            return (self._encode_event(event), None)
+        if self._window.locked():
+            self._flush()
+        await self._acquire_slot()
+        pid = self._next_pid()
+        future = self._expect(PUBACK, pid, 'SEND', slot=True)
+        return (publish_packet(event_topic(self._prefix, event), event_payload(event), 1, pid), future)
+
+    def _decode(self, buffer):
+        (packets, offset) = split_packets(buffer)
+        view = memoryview(buffer)
+        events = []
+        for (first, start, end) in packets:
+            kind = first & 0xF0
+            if kind == PUBLISH:
+                qos = (first >> 1) & 0x03
+                start += 2 + _PID.unpack_from(view, start)[0]
+                if qos:
+                    pid = _PID.unpack_from(view, start)[0]
+                    start += 2
+                    if qos == 1:
+                        self._writer.write(packet(PUBACK, _PID.pack(pid)))
+                try:
+                    events.append(decode_event(view, start, end))
+                except struct.error:
+                    logger.warning('Invalid event payload from the broker')
+            elif kind in (PUBACK, SUBACK, UNSUBACK):
+                self._acknowledged(kind, _PID.unpack_from(view, start)[0], bytes(view[start + 2:end]))
+            elif kind == PINGRESP:
+                self._acknowledged(kind, None, b'')
+            else:
+                logger.warning('Unexpected packet type %x from the broker', kind)
+        return (events, bytes(view[offset:]))
+
+    # api functions
+    async def noop(self):
+        return await self._request(packet(PINGREQ), PINGRESP, None, 'PING')
+
+    async def send(self, event_l, confirm=False):
+        """Publish an event. Without the receive loop only unconfirmed events
+           can be sent, confirmations are read by the receive task."""
+        if not self._rcvloop and confirm:
+            raise RcvloopError('confirmed events require a running receive loop')
+        futures = await self._queue_events((event_l,), confirm)
+        if confirm:
+            return await self._confirmed(futures[0])
+
+    async def send_many(self, events, confirm=False):
+        if not self._rcvloop and confirm:
+            raise RcvloopError('confirmed events require a running receive loop')
+        futures = await self._queue_events(events, confirm)
+        if confirm:
+            return await self._confirmed(asyncio.gather(*futures))
+
+    async def login(self):
+        """Credentials are part of CONNECT"""
+
+    async def setfilter(self, filter):
+        raise ProtoError('MQTT selects events by topic, use subscribe()')
+
+    setmask = setfilter
+
+    def subscription(self, patterns):
+        return tuple(pattern_topics(self._prefix, patterns))
+
+    async def subscribe(self, patterns):
+        """Subscribe to the topics of the patterns, unsubscribe the rest"""
+        topics = set(pattern_topics(self._prefix, patterns))
+        removed = sorted(self._topics - topics)
+        added = sorted(topics - self._topics)
+        if added:
+            pid = self._next_pid()
+            body = _PID.pack(pid) + b''.join(_string(topic) + b'\x00' for topic in added)
+            await self._request(packet(SUBSCRIBE, body), SUBACK, pid, 'SUBSCRIBE')
+        if removed:
+            pid = self._next_pid()
+            body = _PID.pack(pid) + b''.join(_string(topic) for topic in removed)
+            await self._request(packet(UNSUBSCRIBE, body), UNSUBACK, pid, 'UNSUBSCRIBE')
+        self._topics = topics
+
+    async def clrall(self):
+        """Nothing is queued for a clean session"""
+
+    async def quit(self):
+        await self._putcmd(packet(DISCONNECT))
+        await self.close()
+
+    async def rcvloop(self, callback=None, batch_callback=None):
+        self._rcvloop = True
+        self._rcvloop_task = asyncio.create_task(self.rcv_task(callback, batch_callback))
+        self._ping_task = asyncio.create_task(self._keepalive())
+        self._start_watchdog()
+
+    async def _keepalive(self):
+        """Ping the broker. A broker not answering within the command
+           timeout counts as a lost connection, the ping is confirmed like
+           any other command and _confirmed() drops the connection."""
+        while True:
+            await asyncio.sleep(_MQTT_KEEPALIVE / 2)
+            try:
+                await self.noop()
+            except ResponseTimeout:
+                logger.warning('The MQTT broker stopped answering pings')
+                return
+            except ConnectionError:
+                return
+
+    async def quitloop(self):
+        if not self._rcvloop:
+            return
+        self._rcvloop = False
+        self._stop_watchdog()
+        self._ping_task.cancel()
+        self._rcvloop_task.cancel()
+        await self._rcvloop_task
+
+    def _oldest_inflight(self):
+        return min((start for (_, _, start, _) in self._acks.values()), default=None)
+
+    def abort(self):
+        if self._ping_task is not None and self._ping_task is not asyncio.current_task():
+            self._ping_task.cancel()
+        super().abort()
+        self._topics = set()
+        for (future, _, _, slot) in self._acks.values():
+            if slot:
+                self._window.release()
+            if not future.done():
+                future.set_exception(ConnectionError('Connection to the broker lost'))
+        self._acks.clear()
@@ -0,0 +1,147 @@
+import asyncio
+import struct
+import logging
+from .const import (CLASS_VSCP,
+                    EVENT_EXT_PAGE_READ,
+                    EVENT_EXT_PAGE_RESP)
+from .event import Event
+
+logger = logging.getLogger(__name__)
+
+# bytes of register data carried by a single EXT_PAGE_RESP event
+_FRAGMENT_SIZE = 4
+
+
+class ReadTimeout(Exception):
+    pass
+
+
+class _PendingRead:
+    """Book-keeping for a single outstanding register read"""
+    def __init__(self, nickname, page, reg, num, head=0):
+        self.nickname = nickname
+        self.page = page
+        self.reg = reg
+        self.num = num
+        self.head = head
+        self.result = bytearray(num)
+        self.missing = set(range(num))
+        self.done = asyncio.get_running_loop().create_future()
+
+    def feed(self, reg, payload):
+        offset = (reg - self.reg) & 0xFF
+        if offset >= self.num:
+            return  # stale or foreign fragment, outside the requested range
+        for i, value in enumerate(payload[:max(0, self.num - offset)]):
+            self.result[offset + i] = value
+            self.missing.discard(offset + i)
+        if not self.missing and not self.done.done():
+            self.done.set_result(self.result)
+
+    def missing_ranges(self):
+        """Return the missing bytes as a list of (offset, length) tuples"""
+        ranges = []
+        for offset in sorted(self.missing):
+            if ranges and ranges[-1][0] + ranges[-1][1] == offset:
+                ranges[-1] = (ranges[-1][0], ranges[-1][1] + 1)
+            else:
+                ranges.append((offset, 1))
+        return ranges
+
+
+class RegisterReader:
+    """Extended page register reads on top of a running receive loop.
+
+    EXT_PAGE_RESP events are matched to the pending read by nickname, page
+    and register offset. A read completes as soon as all of its bytes have
+    arrived. Missing fragments are requested again after a timeout derived
+    from the measured response time (RFC 6298 style smoothing)."""
+    def __init__(self, vscp, retries=3, min_timeout=0.05, max_timeout=2.0, metrics=None):
+        self._vscp = vscp
+        self._metrics = metrics
+        self._retries = retries
+        self._min_timeout = min_timeout
+        self._max_timeout = max_timeout
+        self._pending = dict()  # key = (nickname, page), value = _PendingRead
+        self._locks = dict()  # one read in flight per (nickname, page)
+        self._srtt = None  # smoothed response time per fragment
+        self._rttvar = None
+
+    def process_event(self, event):
+        """Feed a received event, returns True if it completed a fragment"""
+        if event.vscp_class != CLASS_VSCP or event.vscp_type != EVENT_EXT_PAGE_RESP:
+            return False
+        if len(event.data) < 5:
+            return False
+        (page, reg) = struct.unpack('>HB', event.data[1:4])
+        pending = self._pending.get((event.guid.nickname, page))
+        if pending is None:
+            return False
+        pending.feed(reg, event.data[4:])
+        return True
+
+    def _timeout(self, fragments, attempt):
+        if self._srtt is None:
+            per_fragment = self._max_timeout / 4
+        else:
+            per_fragment = self._srtt + 4 * self._rttvar
+        timeout = per_fragment * fragments * (2 ** attempt)  # back off on retries
+        return min(max(timeout, self._min_timeout), self._max_timeout)
+
+    def _update_rtt(self, sample):
+        if self._srtt is None:
+            self._srtt = sample
+            self._rttvar = sample / 2
+        else:
+            self._rttvar = 0.75 * self._rttvar + 0.25 * abs(self._srtt - sample)
+            self._srtt = 0.875 * self._srtt + 0.125 * sample
+
+    async def _request(self, pending, offset, length):
+        await self._vscp.send(Event(vscp_class=CLASS_VSCP,
+                                    vscp_type=EVENT_EXT_PAGE_READ,
+                                    head=pending.head,
+                                    data=struct.pack('>BHBB', pending.nickname, pending.page,
+                                                     (pending.reg + offset) & 0xFF,
+                                                     0 if length == 256 else length)))
+
+    async def read(self, nickname, page, reg, num=1, priority=0):
+        """Read registers, the requests are sent with VSCP priority (0-7)"""
+        if num == 0:
+            return bytearray()
+        if num > 256:
+            raise ValueError('Register read limited to 256 bytes')
+
+        key = (nickname, page)
+        lock = self._locks.setdefault(key, asyncio.Lock())
+        async with lock:
+            pending = _PendingRead(nickname, page, reg, num, priority << 5)
+            self._pending[key] = pending
+            loop = asyncio.get_running_loop()
+            begin = loop.time()
+            try:
+                ranges = [(0, num)]
+                for attempt in range(self._retries + 1):
+                    fragments = sum((length + _FRAGMENT_SIZE - 1) // _FRAGMENT_SIZE
+                                    for (_, length) in ranges)
+                    start = loop.time()
+                    for (offset, length) in ranges:
+                        await self._request(pending, offset, length)
+                    try:
+                        await asyncio.wait_for(asyncio.shield(pending.done), self._timeout(fragments, attempt))
+                        if attempt == 0:
+                            self._update_rtt((loop.time() - start) / fragments)
+                        if self._metrics is not None:
+                            self._metrics.read_latency.observe(loop.time() - begin)
+                        return pending.result
+                    except asyncio.TimeoutError:
+                        if self._metrics is not None and attempt < self._retries:
+                            self._metrics.read_retries += 1
+                        ranges = pending.missing_ranges()
+                        logger.debug('Register read {}:{}:{} missing {}, retrying'.format(
+                            nickname, page, reg, ranges))
+                if self._metrics is not None:
+                    self._metrics.read_timeouts += 1
+                raise ReadTimeout('No response from node {} page {} register {}'.format(
+                    nickname, page, reg))
+            finally:
+                del self._pending[key]
@@ -0,0 +1,149 @@
+import asyncio
+import collections
+import contextlib
+import logging
+
+logger = logging.getLogger(__name__)
+
+# traffic classes, in order of precedence
+INTERACTIVE = 0  # user commands: light switching, services
+RESYNC = 1  # state reads after a reconnect
+DISCOVERY = 2  # node enumeration and other maintenance
+
+CLASS_NAMES = {INTERACTIVE: 'interactive', RESYNC: 'resync', DISCOVERY: 'discovery'}
+
+# VSCP priority (0 highest, 7 lowest) of the events sent for every class,
+# on CAN it decides the arbitration between frames waiting for the bus
+PRIORITY = {INTERACTIVE: 1, RESYNC: 4, DISCOVERY: 6}
+
+# background operations admitted per second and in a burst
+DEF_RATE = 200
+DEF_BURST = 16
+
+# seconds background traffic pauses after interactive traffic, so the
+# interactive frames don't queue behind it in the daemon
+DEF_HOLD = 0.05
+
+# seconds after which a waiting operation is admitted ahead of higher classes
+DEF_MAX_WAIT = 2.0
+
+
+class Scheduler:
+    """Admission control for the outbound traffic of a gateway.
+
+    Interactive traffic is never delayed, it only holds back background
+    traffic for a moment. Background operations (register reads of resync
+    and discovery) wait for a token of a shared bucket (rate per second,
+    burst) and for a free slot (max_inflight operations at a time). Waiting
+    operations are admitted by class, then in order of arrival. An operation
+    waiting longer than max_wait goes first whatever its class, so discovery
+    is slowed down by resync but never stalled. A rate of 0 disables the
+    rate limit."""
+    def __init__(self, rate=DEF_RATE, burst=DEF_BURST, max_inflight=4, hold=DEF_HOLD,
+                 max_wait=DEF_MAX_WAIT, metrics=None):
+        self._rate = rate
+        self._burst = burst
+        self._max_inflight = max_inflight
+        self._hold = hold
+        self._max_wait = max_wait
+        self._metrics = metrics
+        self._tokens = burst
+        self._last_fill = None
+        self._hold_until = 0.0
+        self._inflight = 0
+        self._waiting = {RESYNC: collections.deque(), DISCOVERY: collections.deque()}  # (enqueued, future)
+        self._timer = None
+        self.admitted = {name: 0 for name in CLASS_NAMES.values()}
+        self.starved = 0  # admissions forced by max_wait
+
+    def _fill(self, now):
+        if self._last_fill is not None and self._rate:
+            self._tokens = min(self._burst, self._tokens + (now - self._last_fill) * self._rate)
+        self._last_fill = now
+
+    def _next(self, now):
+        """Return the class of the waiter to admit next"""
+        oldest = None
+        for traffic, queue in self._waiting.items():
+            while queue and queue[0][1].done():  # cancelled while waiting
+                queue.popleft()
+            if queue and (oldest is None or queue[0][0] < self._waiting[oldest][0][0]):
+                oldest = traffic
+        if oldest is None:
+            return None
+        if now - self._waiting[oldest][0][0] >= self._max_wait:
+            self.starved += 1
+            return oldest
+        return next(traffic for traffic, queue in self._waiting.items() if queue)
+
+    def _pump(self):
+        """Admit waiting operations as far as tokens, slots and the hold allow"""
+        self._timer = None
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        self._fill(now)
+        while self._inflight < self._max_inflight:
+            if now < self._hold_until:
+                self._timer = loop.call_at(self._hold_until, self._pump)
+                return
+            if self._rate and self._tokens < 1:
+                self._timer = loop.call_later((1 - self._tokens) / self._rate, self._pump)
+                return
+            traffic = self._next(now)
+            if traffic is None:
+                return
+            (enqueued, future) = self._waiting[traffic].popleft()
+            self._tokens -= 1
+            self._inflight += 1
+            future.set_result(None)
+            self.admitted[CLASS_NAMES[traffic]] += 1
+            if self._metrics is not None:
+                self._metrics.admission(CLASS_NAMES[traffic], now - enqueued)
+
+    def _wake(self):
+        if self._timer is not None:
+            self._timer.cancel()
+        self._pump()
+
+    def interactive(self):
+        """Note interactive traffic, background traffic pauses for hold"""
+        loop = asyncio.get_running_loop()
+        self._hold_until = loop.time() + self._hold
+        self.admitted[CLASS_NAMES[INTERACTIVE]] += 1
+
+    @contextlib.asynccontextmanager
+    async def slot(self, traffic):
+        """Run an operation of a traffic class once it is admitted"""
+        if traffic == INTERACTIVE:
+            self.interactive()
+            yield
+            return
+        future = asyncio.get_running_loop().create_future()
+        self._waiting[traffic].append((asyncio.get_running_loop().time(), future))
+        self._wake()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self._release()  # admitted and cancelled at the same time
+            raise
+        try:
+            yield
+        finally:
+            self._release()
+
+    def _release(self):
+        self._inflight -= 1
+        self._wake()
+
+    @property
+    def waiting(self):
+        return {CLASS_NAMES[traffic]: sum(1 for (_, future) in queue if not future.done())
+                for traffic, queue in self._waiting.items()}
+
+    def as_dict(self):
+        return {'rate': self._rate,
+                'inflight': self._inflight,
+                'waiting': self.waiting,
+                'admitted': dict(self.admitted),
+                'starved': self.starved}
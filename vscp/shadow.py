@@ -0,0 +1,109 @@
+import struct
+from .const import (CLASS_VSCP, EVENT_EXT_PAGE_RESP)
+from .util import read_reg
+
+# registers from here on are the standard registers, the same on every page
+STD_REG_BASE = 0x80
+
+# page holding the standard registers in the shadow
+_STD_PAGE = 0
+
+
+def _segments(page, reg, num):
+    """Split a register range in (shadow page, first register, count)
+       parts, the standard registers are kept on a single page"""
+    end = reg + num
+    if reg < STD_REG_BASE < end:
+        return [(page, reg, STD_REG_BASE - reg), (_STD_PAGE, STD_REG_BASE, end - STD_REG_BASE)]
+    return [(_STD_PAGE if reg >= STD_REG_BASE else page, reg, num)]
+
+
+def _mask(reg, num):
+    return ((1 << num) - 1) << reg
+
+
+class ShadowRegisters:
+    """Shadow copy of the registers of a node, keyed by (page, register).
+
+    Reads are served from the shadow where all requested registers are
+    valid, missing ones are read from the bus and kept. Register writes are
+    taken over from their confirmation (EXT_PAGE_RESP) by process_event()
+    like any other response. invalidate() marks pages dirty, their
+    registers are read from the bus again the next time. Reads go out with VSCP priority unless a call gives another,
+    options are passed on to the reads of vscp (a call can override them)."""
+    def __init__(self, vscp, nickname, priority=0, **options):
+        self._vscp = vscp
+        self.nickname = nickname
+        self.priority = priority
+        self.options = options
+        self._values = dict()  # page -> bytearray(256)
+        self._valid = dict()  # page -> bit mask of valid registers
+        self._known = dict()  # page -> bit mask of registers ever read
+        self._dirty = set()
+        self.hits = 0
+        self.misses = 0
+
+    def _store(self, page, reg, values):
+        for (shadow, first, count) in _segments(page, reg, len(values)):
+            offset = first - reg
+            data = self._values.setdefault(shadow, bytearray(256))
+            data[first:first + count] = values[offset:offset + count]
+            mask = _mask(first, count)
+            valid = self._valid[shadow] = self._valid.get(shadow, 0) | mask
+            known = self._known[shadow] = self._known.get(shadow, 0) | mask
+            if valid & known == known:
+                self._dirty.discard(shadow)
+
+    def process_event(self, event):
+        """Take over register contents from an EXT_PAGE_RESP of the node"""
+        if event.vscp_class != CLASS_VSCP or event.vscp_type != EVENT_EXT_PAGE_RESP:
+            return False
+        if event.guid.nickname != self.nickname or len(event.data) < 5:
+            return False
+        (page, reg) = struct.unpack('>HB', event.data[1:4])
+        payload = event.data[4:4 + 256 - reg]
+        self._store(page, reg, payload)
+        return True
+
+    def cached(self, page, reg, num=1):
+        """Return the registers if all of them are valid, None otherwise"""
+        result = bytearray()
+        for (shadow, first, count) in _segments(page, reg, num):
+            mask = _mask(first, count)
+            if self._valid.get(shadow, 0) & mask != mask:
+                return None
+            result += self._values[shadow][first:first + count]
+        return bytes(result)
+
+    async def read(self, page, reg, num=1, cached=True, priority=None, **options):
+        """Read registers, from the shadow when valid. With cached unset
+           the registers are always read from the bus."""
+        if reg + num > 256:
+            raise ValueError('Register range exceeds the page')
+        if cached:
+            result = self.cached(page, reg, num)
+            if result is not None:
+                self.hits += 1
+                return result
+        self.misses += 1
+        if priority is None:
+            priority = self.priority
+        values = bytes(await read_reg(self._vscp, self.nickname, page, reg, num, priority,
+                                      **dict(self.options, **options)))
+        self._store(page, reg, values)
+        return values
+
+    def invalidate(self, page=None):
+        """Mark a page, or all pages without page, dirty"""
+        pages = list(self._known) if page is None else [page]
+        for page in pages:
+            self._valid.pop(page, None)
+            if page in self._known:
+                self._dirty.add(page)
+
+    @property
+    def dirty(self):
+        return sorted(self._dirty)
+
+    def as_dict(self):
+        return {'pages': len(self._known), 'dirty': self.dirty, 'hits': self.hits, 'misses': self.misses}
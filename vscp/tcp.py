@@ -1,7 +1,8 @@
-import asyncio
-from .event import Event
-from .const import (DEF_HOST, DEF_PORT, DEF_USER, DEF_PASSWORD)
 import logging
+import time
+from .event import Event
+from .transport import (Transport, DEF_WINDOW,  # noqa: F401
+                        ProtoError, RcvloopError, ParError, CredError)
 
 logger = logging.getLogger(__name__)
 
@@ -11,59 +12,47 @@ def _strip_line(line):
         return line[:-2]
     if line.endswith(b'\r') or line.endswith(b'\n'):
         return line[:-1]
+    return line
 
-# maximal line length when calling readline()
+# maximal line length accepted from the daemon
 _MAXLINE = 2048
 
+# the daemon sends a bare +OK as keep-alive in the receive loop, it is only
+# taken as one while no command waits for its response
+_KEEPALIVE = b'+OK'
+
 # Line terminators
 CR = '\r'
 LF = '\n'
 CRLF = CR+LF
+_SEND_PREFIX = b'SEND '
+_CRLF = b'\r\n'
 
-class ProtoError(Exception):
-    pass
-
-class RcvloopError(Exception):
-    pass
-    
-class ParError(Exception):
-    pass
-
-class CredError(Exception):
-    pass
-
-class TCP:
-    """This is a wrapper to a VSCP TCP daemon"""
-    def __init__(self, host=DEF_HOST, port=DEF_PORT, user=DEF_USER,
-                 password=DEF_PASSWORD):
-        """Initialize a VscpTCP object"""
-        if (user == None) != (password == None):
-            raise ParError('User and password should both be None or defined')
-            
-        self._host = host
-        self._port = port
-        self._user = user
-        self._password = password
+class TCP(Transport):
+    """This is a wrapper to a VSCP TCP daemon, speaking the text protocol"""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
         self.debuglevel = 0
-        self._rcvloop = False
 
-    async def connect(self):
-        """Connect to a vscpd instance"""
-        self._reader, self._writer = \
-            await asyncio.open_connection(self._host, self._port)
+    async def _handshake(self):
         self._welcome = await self._getlongresp()
-        
-        if self._user != None:
-            try:
-                await self.user()
-            except ProtoError:
-                raise CredError('Invalid username')
-        
-        if self._password != None:
-            try:
-                await self.password()
-            except ProtoError:
-                raise CredError('Invalid password')
+        await self.login()
+
+    def _encode_command(self, verb, arg=None):
+        if verb == 'SEND':
+            arg = repr(arg)
+        elif verb == 'SFLT':
+            arg = arg.filter_str()
+        elif verb == 'SMSK':
+            arg = arg.filter_mask_str()
+        line = verb if arg is None else verb + ' ' + str(arg)
+        return (line + CRLF).encode()
+
+    def _encode_event(self, event):
+        return _SEND_PREFIX + event.encode() + _CRLF
+
+    async def _read_response(self):
+        return await self._getresp()
 
     # Internal stuff
     async def _getresp(self):
@@ -88,130 +77,55 @@ class TCP:
             list.append(_strip_line(line))
         return line, list
 
-    async def _putcmd(self, line):
-        logger.debug('*cmd* ' + repr(line))
-        line = line + CRLF
-        self._writer.write(line.encode())
-        await self._writer.drain()
-
-    async def _shortcmd(self, line):
-        await self._putcmd(line)
-        if not self._rcvloop:
-            return await self._getresp()
-        else:
-            return
-
-    async def _longcmd(self, line, neg_resp = False):
-        await self._putcmd(line)
-        if not self._rcvloop:
-            return await self._getlongresp(neg_resp)
-        else:
-            return
+    async def _longcmd(self, verb, arg=None, neg_resp = False):
+        if self._rcvloop:
+            raise RcvloopError
+        start = time.perf_counter()
+        await self._putcmd(self._encode_command(verb, arg))
+        resp = await self._getlongresp(neg_resp)
+        if self.metrics is not None:
+            self.metrics.command(verb, time.perf_counter() - start)
+        return resp
 
     #convenience functions
     def getwelcome(self):
         return self._welcome[1]
 
     #api functions
-    async def noop(self):
-        """Does nothing.
-        One supposes the response indicates the server is alive.
-        """
-        return await self._shortcmd('NOOP')
-
-    async def send(self, event_l):
-        """Send event to the daemon"""
-        if not isinstance(event_l, Event):
-            raise ProtoError('event should be of class event')
-        logger.debug('TX: {}'.format(event_l))
-        return await self._shortcmd('SEND ' + repr(event_l))
-
     async def retr(self, num=1):
         """Get events from the buffer"""
-        if self._rcvloop:
-            raise RcvloopError
-        resp = await self._longcmd('RETR ' + str(num), neg_resp=True)
+        resp = await self._longcmd('RETR', num, neg_resp=True)
         return (resp[0], Event.from_string_list([x.decode() for x in resp[1]]))
 
-    async def user(self):
-        if self._rcvloop:
-            raise RcvloopError
-        return await self._shortcmd('USER ' + self._user)
-
-    async def password(self):
-        if self._rcvloop:
-            raise RcvloopError
-        return await self._shortcmd('PASS ' + self._password)
-
     async def chkdata(self):
-        if self._rcvloop:
-            raise RcvloopError
         resp = await self._longcmd('CDTA')
-        return (resp[0], int(resp[1][0].decode()), resp[2])
-
-    async def setfilter(self, filter):
-        return await self._shortcmd('SFLT ' + filter.filter_str())
-
-    async def setmask(self, filter):
-        return await self._shortcmd('SMSK ' + filter.filter_mask_str())
-
-    async def clrall(self):
-        if self._rcvloop:
-            raise RcvloopError
-        return await self._shortcmd('CLRA')
-
-    async def quit(self):
-        """Signoff"""
-        resp = await self._shortcmd('QUIT')
-        await self.close()
-        return resp
-
-    async def rcv_task(self, callback):
-        while True:
+        return (resp[0], int(resp[1][0].decode()))
+
+    def _decode(self, buffer):
+        """Split received bytes in lines, a partial last line is returned as rest"""
+        lines = buffer.split(b'\n')
+        rest = lines.pop()
+        if len(rest) > _MAXLINE:
+            logger.warning('Dropping overlong line from the daemon')
+            rest = b''
+        return (self._parse_lines(lines), rest)
+
+    def _parse_lines(self, lines):
+        """Parse a batch of received lines, returns the list of events"""
+        events = []
+        for line in lines:
+            if not line or line == b'\r':
+                continue
+            if line.startswith(b'+') or line.startswith(b'-'):
+                line = line.rstrip(b'\r')
+                if line != _KEEPALIVE or self._inflight:
+                    self._response(line.startswith(b'+'), line)
+                continue
             try:
-                line = await self._reader.readline()
-            except asyncio.CancelledError:
-                return
-            except:
-                logger.exception('Unhandled exception in receive loop!!')
-            if line.startswith(b'+') or len(line) == 0:
-                pass
-            elif line.startswith(b'-'):
-                raise ProtoError(resp)
-            else:
-                try:
-                    event = Event.from_string(line.decode())
-                    logger.debug('RX: {}'.format(event))
-                    await callback(event)
-                except Exception as e:
-                    logger.exception('Unhandled exception: {}'.format(e))
-
-    async def rcvloop(self, callback):
-        """start a receive loop, calling the callback for every event"""
-        self._rcvloop = True
-        await self._shortcmd('RCVLOOP')
-        self._rcvloop_task = asyncio.create_task(self.rcv_task(callback))
-
-    async def quitloop(self):
-        """stop the receive loop"""
-        if not self._rcvloop:
-            return
-        await self._shortcmd('QUITLOOP')
-        self._rcvloop = False
-        try:
-            self._rcvloop_task.cancel()
-        except asyncio.CancelledError:
-            pass
-        await self._rcvloop_task
-
-    async def close(self):
-        """Close the connection without assuming anything about it."""
-        await self.quitloop()
-        try:
-            stream = self._writer
-            self._writer = None
-            if stream is not None:
-                stream.close()
-                await stream.wait_closed()
-        finally:
-            pass
+                event = Event.from_string(line.decode())
+            except Exception:
+                logger.exception('Invalid event line %r', line)
+                continue
+            logger.debug('RX: %s', event)
+            events.append(event)
+        return events
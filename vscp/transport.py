@@ -0,0 +1,487 @@
+import asyncio
+import collections
+import socket
+import time
+from .event import Event
+from .filter import Filter
+from .register import RegisterReader
+from .const import (DEF_HOST, DEF_PORT, DEF_USER, DEF_PASSWORD)
+import logging
+
+logger = logging.getLogger(__name__)
+
+# bytes requested per read in the receive loop
+_READ_SIZE = 65536
+
+# pending outbound bytes above which senders wait for the socket to drain
+_HIGH_WATER = 16384
+
+# commands in flight in the receive loop, waiting for their response
+DEF_WINDOW = 32
+
+# seconds to wait for the response to a command in the receive loop, without
+# it responses can no longer be matched to their commands and the connection
+# is dropped. Applies to every command in flight, confirmed or not.
+DEF_COMMAND_TIMEOUT = 10
+
+# TCP keepalive, a silently dropped connection is noticed after about 25s
+_KEEPALIVE_IDLE = 10
+_KEEPALIVE_INTERVAL = 5
+_KEEPALIVE_COUNT = 3
+
+class ProtoError(Exception):
+    pass
+
+class RcvloopError(Exception):
+    pass
+
+class ParError(Exception):
+    pass
+
+class CredError(Exception):
+    pass
+
+class ResponseTimeout(Exception):
+    pass
+
+class Transport:
+    """Connection to a VSCP daemon, independent of the wire format.
+
+    Subclasses implement the encoding:
+    - _handshake(): read the welcome and log in after connecting
+    - _encode_command(verb, arg): bytes of a command (NOOP, SEND, SFLT, ...)
+    - _encode_event(event): bytes of a SEND command for an event
+    - _read_response(): read the response to a command outside the receive loop
+    - _decode(buffer): parse received bytes in the receive loop, returns the
+      events and the unparsed rest. Responses are passed to _response().
+    Transports which don't select events with a daemon filter override
+    subscription() and subscribe().
+
+    Outside the receive loop every command waits for its response. In the
+    receive loop commands are pipelined: up to window commands are in flight
+    and responses are matched to them in order while events keep flowing."""
+    def __init__(self, host=DEF_HOST, port=DEF_PORT, user=DEF_USER,
+                 password=DEF_PASSWORD, metrics=None, on_lost=None, window=DEF_WINDOW,
+                 command_timeout=DEF_COMMAND_TIMEOUT):
+        """metrics is an optional vscp.metrics.Metrics instance to account
+           traffic in. on_lost is called when the connection drops during the
+           receive loop. window limits the number of commands in flight in
+           the receive loop, command_timeout the wait for their responses."""
+        if (user == None) != (password == None):
+            raise ParError('User and password should both be None or defined')
+
+        self._host = host
+        self._port = port
+        self._user = user
+        self._password = password
+        self._reader = None
+        self._writer = None
+        self._rcvloop = False
+        self._rcvloop_task = None
+        self._listeners = []
+        self.metrics = metrics
+        self._on_lost = on_lost
+        self.registers = RegisterReader(self, metrics=metrics)
+        self._outbox = []  # encoded SEND commands waiting for the next flush
+        self._outbox_size = 0
+        self._flush_handle = None
+        # commands written in the receive loop, in order: (future or None, verb, start time)
+        self._inflight = collections.deque()
+        self._window = asyncio.Semaphore(window)
+        self._command_timeout = command_timeout
+        self._watchdog = None  # timer checking the oldest command in flight
+
+    async def connect(self):
+        """Connect to a vscpd instance"""
+        self._reader, self._writer = \
+            await asyncio.open_connection(self._host, self._port)
+        self._set_keepalive()
+        await self._handshake()
+
+    async def _handshake(self):
+        raise NotImplementedError
+
+    def _encode_command(self, verb, arg=None):
+        raise NotImplementedError
+
+    def _encode_event(self, event):
+        raise NotImplementedError
+
+    async def _read_response(self):
+        raise NotImplementedError
+
+    def _decode(self, buffer):
+        raise NotImplementedError
+
+    def _set_keepalive(self):
+        sock = self._writer.get_extra_info('socket')
+        if sock is None:
+            return
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        for option, value in (('TCP_KEEPIDLE', _KEEPALIVE_IDLE),
+                              ('TCP_KEEPINTVL', _KEEPALIVE_INTERVAL),
+                              ('TCP_KEEPCNT', _KEEPALIVE_COUNT)):
+            if hasattr(socket, option):
+                sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, option), value)
+
+    @property
+    def connected(self):
+        return self._writer is not None
+
+    # Internal stuff
+    async def _putcmd(self, data):
+        if self._writer is None:
+            raise ConnectionError('Not connected to the daemon')
+        logger.debug('*cmd* %r', data)
+        self._flush()  # keep the order with queued events
+        self._writer.write(data)
+        await self._writer.drain()
+
+    def _flush(self):
+        """Write all queued SEND commands to the socket in one go"""
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if self._outbox and self._writer is not None:
+            self._writer.write(b''.join(self._outbox))
+            self._outbox.clear()
+            self._outbox_size = 0
+
+    async def _queue_events(self, events, confirm=False):
+        """Queue events, they are written out once per event loop iteration.
+           Waits for the socket to drain when the daemon is lagging behind and
+           for a free slot when the window of commands in flight is full.
+           Returns a future per event with confirm set, None otherwise."""
+        if self._writer is None:
+            raise ConnectionError('Not connected to the daemon')
+        futures = []
+        for event in events:
+            if not isinstance(event, Event):
+                raise ProtoError('event should be of class event')
+            logger.debug('TX: %s', event)
+            (data, future) = await self._prepare_event(event, confirm)
+            self._outbox.append(data)
+            self._outbox_size += len(data)
+            futures.append(future)
+        if self.metrics is not None:
+            self.metrics.sent_events(events)
+            self.metrics.outbox_depth.observe(len(self._outbox))
+
+        if self._outbox_size + self._writer.transport.get_write_buffer_size() > _HIGH_WATER:
+            self._flush()
+            await self._writer.drain()
+        elif self._flush_handle is None:
+            self._flush_handle = asyncio.get_running_loop().call_soon(self._flush)
+        return futures
+
+    async def _prepare_event(self, event, confirm):
+        """Return the bytes to queue for an event and the future of its
+           response (None without confirm), after taking a window slot"""
+        if self._window.locked():
+            self._flush()  # queued commands have to go out before their responses can free the window
+        await self._acquire_slot()
+        return (self._encode_event(event), self._track('SEND', confirm))
+
+    async def _acquire_slot(self):
+        await self._window.acquire()
+        if self._writer is None:  # dropped while waiting for the window
+            self._window.release()
+            raise ConnectionError('Not connected to the daemon')
+
+    def _track(self, verb, confirm):
+        """Register a command written in the receive loop. Returns the future
+           of its response with confirm set, otherwise None."""
+        future = asyncio.get_running_loop().create_future() if confirm else None
+        self._inflight.append((future, verb, time.perf_counter()))
+        return future
+
+    def _response(self, ok, response):
+        """Match a response of the receive loop to the oldest command in flight"""
+        if not self._inflight:
+            logger.debug('Unexpected response in receive loop: %r', response)
+            return
+        (future, verb, start) = self._inflight.popleft()
+        self._window.release()
+        if self.metrics is not None:
+            self.metrics.command(verb, time.perf_counter() - start)
+        if not ok:
+            if future is None:
+                logger.warning('Daemon rejected %s: %r', verb, response)
+            elif not future.done():
+                future.set_exception(ProtoError(response))
+        elif future is not None and not future.done():
+            future.set_result(response)
+
+    async def _confirmed(self, awaitable):
+        """Wait for the response(s) to commands written in the receive loop.
+           A response which does not arrive in time leaves the commands in
+           flight out of step with the responses, the connection is dropped
+           and ResponseTimeout is raised."""
+        try:
+            return await asyncio.wait_for(awaitable, self._command_timeout)
+        except asyncio.TimeoutError:
+            logger.warning('No response from the daemon in {}s, dropping the connection'.format(
+                self._command_timeout))
+            self._connection_lost()
+            raise ResponseTimeout('No response from the daemon')
+
+    def _oldest_inflight(self):
+        """Start time of the oldest command waiting for its response, or None"""
+        return self._inflight[0][2] if self._inflight else None
+
+    def _start_watchdog(self):
+        self._watchdog = asyncio.get_running_loop().call_later(self._command_timeout / 4,
+                                                               self._check_inflight)
+
+    def _stop_watchdog(self):
+        if self._watchdog is not None:
+            self._watchdog.cancel()
+            self._watchdog = None
+
+    def _check_inflight(self):
+        """Drop the connection when a command waits longer than the command
+           timeout, its window slot would never be released otherwise"""
+        self._watchdog = None
+        if not self._rcvloop:
+            return
+        oldest = self._oldest_inflight()
+        if oldest is not None and time.perf_counter() - oldest > self._command_timeout:
+            logger.warning('No response from the daemon in {}s, dropping the connection'.format(
+                self._command_timeout))
+            self._connection_lost()
+            return
+        self._start_watchdog()
+
+    async def _shortcmd(self, verb, arg=None):
+        data = self._encode_command(verb, arg)
+        if self._rcvloop:
+            await self._acquire_slot()
+            future = self._track(verb, True)
+            await self._putcmd(data)
+            return await self._confirmed(future)
+        start = time.perf_counter()
+        await self._putcmd(data)
+        resp = await self._read_response()
+        if self.metrics is not None:
+            self.metrics.command(verb, time.perf_counter() - start)
+        return resp
+
+    def add_listener(self, listener):
+        """Call listener(event) for every event received in the receive loop"""
+        self._listeners.append(listener)
+
+    def remove_listener(self, listener):
+        self._listeners.remove(listener)
+
+    #api functions
+    async def noop(self):
+        """Does nothing.
+        One supposes the response indicates the server is alive.
+        """
+        return await self._shortcmd('NOOP')
+
+    @property
+    def outbox_depth(self):
+        """Number of events waiting to be written"""
+        return len(self._outbox)
+
+    async def send(self, event_l, confirm=False):
+        """Send event to the daemon. In the receive loop the event is queued,
+           with confirm set this waits for the response of the daemon and
+           raises ProtoError when the event was rejected."""
+        if self._rcvloop:
+            futures = await self._queue_events((event_l,), confirm)
+            if confirm:
+                return await self._confirmed(futures[0])
+            return
+        if not isinstance(event_l, Event):
+            raise ProtoError('event should be of class event')
+        logger.debug('TX: %s', event_l)
+        if self.metrics is not None:
+            self.metrics.sent_events((event_l,))
+        return await self._shortcmd('SEND', event_l)
+
+    async def send_many(self, events, confirm=False):
+        """Send a number of events, coalesced in a single write. With confirm
+           set this waits for the responses to all of them."""
+        if self._rcvloop:
+            futures = await self._queue_events(events, confirm)
+            if confirm:
+                return await self._confirmed(asyncio.gather(*futures))
+            return
+        for event in events:
+            await self.send(event)
+
+    async def user(self):
+        if self._rcvloop:
+            raise RcvloopError
+        return await self._shortcmd('USER', self._user)
+
+    async def password(self):
+        if self._rcvloop:
+            raise RcvloopError
+        return await self._shortcmd('PASS', self._password)
+
+    async def login(self):
+        if self._user != None:
+            try:
+                await self.user()
+            except ProtoError:
+                raise CredError('Invalid username')
+
+        if self._password != None:
+            try:
+                await self.password()
+            except ProtoError:
+                raise CredError('Invalid password')
+
+    async def setfilter(self, filter):
+        return await self._shortcmd('SFLT', filter)
+
+    async def setmask(self, filter):
+        return await self._shortcmd('SMSK', filter)
+
+    def subscription(self, patterns):
+        """Return a description of what subscribe(patterns) installs, equal
+           descriptions select the same events"""
+        flt = Filter.covering(patterns)
+        return (flt.filter_str(), flt.filter_mask_str())
+
+    async def subscribe(self, patterns):
+        """Select the events to receive by (class, type, nickname) patterns,
+           None fields match any value. The daemon filter passes at least the
+           matching events, and possibly others."""
+        flt = Filter.covering(patterns)
+        await self.setmask(flt)
+        await self.setfilter(flt)
+
+    async def clrall(self):
+        if self._rcvloop:
+            raise RcvloopError
+        return await self._shortcmd('CLRA')
+
+    async def read_registers(self, nickname, page, reg, num=1, priority=0):
+        """Read registers of a node, requires a running receive loop. The
+           requests are sent with VSCP priority (0-7)."""
+        if not self._rcvloop:
+            raise RcvloopError('register reads require a running receive loop')
+        return await self.registers.read(nickname, page, reg, num, priority)
+
+    async def quit(self):
+        """Signoff"""
+        resp = await self._shortcmd('QUIT')
+        await self.close()
+        return resp
+
+    async def rcv_task(self, callback, batch_callback=None):
+        """Read everything buffered at once and decode it as one batch.
+           Incomplete data at the end is kept for the next read."""
+        pending = b''
+        while True:
+            try:
+                chunk = await self._reader.read(_READ_SIZE)
+            except asyncio.CancelledError:
+                return
+            except OSError as e:
+                logger.warning('Connection to the daemon lost: {!r}'.format(e))
+                break
+            except Exception:
+                logger.exception('Unhandled exception in receive loop!!')
+                break
+            if not chunk:
+                logger.warning('Connection closed by the daemon')
+                break
+
+            start = time.perf_counter()
+            try:
+                (events, pending) = self._decode(pending + chunk)
+            except ProtoError as e:
+                logger.warning('Protocol error in receive loop: {!r}'.format(e))
+                break
+            if events:
+                await self._deliver(events, callback, batch_callback, start)
+        self._connection_lost()
+
+    async def _deliver(self, events, callback, batch_callback, start):
+        """Hand a batch of received events to the register reader, the
+           listeners and the callbacks. start is when decoding began."""
+        metrics = self.metrics
+        if metrics is not None:
+            parsed = time.perf_counter()
+            metrics.received_batch(events, parsed - start)
+        try:
+            for event in events:
+                self.registers.process_event(event)
+                for listener in self._listeners:
+                    listener(event)
+            if batch_callback is not None:
+                await batch_callback(events)
+            elif callback is not None:
+                for event in events:
+                    await callback(event)
+            if metrics is not None:
+                metrics.dispatched_batch(len(events), time.perf_counter() - parsed)
+        except Exception as e:
+            logger.exception('Unhandled exception: {}'.format(e))
+
+    def _connection_lost(self):
+        """The receive loop ended without quitloop, drop the connection"""
+        self.abort()
+        if self._on_lost is not None:
+            self._on_lost()
+
+    async def rcvloop(self, callback=None, batch_callback=None):
+        """start a receive loop, calling the callback for every event or
+           batch_callback with the list of events decoded from every read"""
+        await self._shortcmd('RCVLOOP')
+        self._rcvloop = True
+        self._rcvloop_task = asyncio.create_task(self.rcv_task(callback, batch_callback))
+        self._start_watchdog()
+
+    async def quitloop(self):
+        """stop the receive loop"""
+        if not self._rcvloop:
+            return
+        await self._shortcmd('QUITLOOP')
+        self._rcvloop = False
+        self._stop_watchdog()
+        try:
+            self._rcvloop_task.cancel()
+        except asyncio.CancelledError:
+            pass
+        await self._rcvloop_task
+
+    def abort(self):
+        """Drop the connection at once, without any protocol traffic.
+           Queued events are discarded."""
+        self._rcvloop = False
+        self._stop_watchdog()
+        task = self._rcvloop_task
+        if task is not None and task is not asyncio.current_task():
+            task.cancel()
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        self._outbox.clear()
+        self._outbox_size = 0
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        while self._inflight:
+            (future, _, _) = self._inflight.popleft()
+            self._window.release()
+            if future is not None and not future.done():
+                future.set_exception(ConnectionError('Connection to the daemon lost'))
+
+    async def close(self):
+        """Close the connection without assuming anything about it."""
+        await self.quitloop()
+        try:
+            self._flush()
+            stream = self._writer
+            self._writer = None
+            if stream is not None:
+                stream.close()
+                await stream.wait_closed()
+        finally:
+            pass
@@ -2,11 +2,9 @@ import asyncio
 from .const import (CLASS_VSCP,
                     EVENT_WHO_IS_THERE,
                     EVENT_WHO_IS_THERE_RESPONSE,
-                    EVENT_EXT_PAGE_RESP,
-                    EVENT_EXT_PAGE_READ,
                     EVENT_EXT_PAGE_WRITE,
+                    NICKNAME_ALL,
                     STD_REG_LENGTH)
-from .filter import Filter
 from .event import Event
 from .guid import Guid
 import struct
@@ -19,62 +17,66 @@ async def write_reg(vscp, page, reg, nickname, value):
                           vscp_type = EVENT_EXT_PAGE_WRITE,
                           data = data_prefix + value))
 
-async def read_reg(vscp, nickname, page, reg, num=1):
-    if num == 0:
-        return bytearray()
-    if num == 256:
-        num_cmd = 0
-    else:
-        num_cmd = num
-
-    await vscp.quitloop()
-    flt = Filter(0,0,0,0x3ff,EVENT_EXT_PAGE_RESP,0xFF)
-    await vscp.setmask(flt)
-    await vscp.setfilter(flt)
-    await vscp.clrall()
-
-    tx_event = Event(vscp_class = CLASS_VSCP,
-                     vscp_type  = EVENT_EXT_PAGE_READ,
-                     data = struct.pack('>BHBB', nickname, page, reg,num_cmd))
-
-    await vscp.send(tx_event)
-
-    await asyncio.sleep(0.005 * num + 0.01)
-    resp = await vscp.retr(int(num/4)+2)
-    resp = [x for x in resp[1] if x.guid.nickname == nickname]
-    result=bytearray(num_cmd)
-    for item in resp:
-        result[item.data[3]-reg:item.data[3]-reg+len(item.data)-4] = item.data[4:]
-    return result
+async def read_reg(vscp, nickname, page, reg, num=1, priority=0, **options):
+    """Read registers from a node, completes as soon as all bytes arrived.
+    Further options are passed on to vscp.read_registers()."""
+    return await vscp.read_registers(nickname, page, reg, num, priority, **options)
 
 async def read_std_reg(vscp, nickname, reg):
     return await read_reg(vscp, nickname, 0, reg, STD_REG_LENGTH[reg])
 
-async def who_is_there(vscp, nickname):
-    guid = None
-    mdf  = None
+def _assemble_who_is_there(fragments):
+    """Assemble the 7 response fragments of a node into (guid, mdf)"""
+    raw = bytearray(7 * 7)
+    for index, payload in fragments.items():
+        offset = index * 7
+        raw[offset:offset + 7] = payload
 
-    await vscp.quitloop()
-    flt = Filter(0,0,0,0x3ff,EVENT_WHO_IS_THERE_RESPONSE,0xFF)
-    await vscp.setmask(flt)
-    await vscp.setfilter(flt)
-    await vscp.clrall()
+    guid = Guid(bytes([byte for byte in reversed(raw[0:16])]))
+    mdf = raw[16:].split(b'\0')[0].decode()
+    return guid, mdf
 
-    await vscp.send(Event(vscp_class=0, vscp_type=EVENT_WHO_IS_THERE,
-                          data=struct.pack('>B', nickname)))
-    await asyncio.sleep(0.01)  # allow time for replies & spare bandwidth
-    resp = await vscp.retr(100)
+async def who_is_there_all(vscp, window=0.5, priority=0, retries=3):
+    """Probe all nodes on the segment with a single broadcast who's there.
 
-    filtered = [x for x in resp[1] if x.guid.nickname == nickname]
+    Responses are taken from the running receive loop until no new
+    fragment arrived for `window` seconds. Nodes of which fragments are
+    missing are probed again with a who's there to their nickname, up to
+    `retries` times, the fragments of all answers are merged. Returns a dict
+    nickname -> (guid, mdf) containing every node that delivered all of
+    its response fragments. The probes are sent with VSCP priority."""
+    loop = asyncio.get_running_loop()
+    fragments = dict()  # nickname -> {fragment index: payload}
+    last_rx = loop.time()
 
-    if len(filtered) == 7:
-        # assemble all the data in order
-        raw = bytearray(7 * 7)
-        for ev in filtered:
-            offset = int(ev.data[0]) * 7
-            raw[offset:offset + 7] = ev.data[1:]
+    def collect(ev):
+        nonlocal last_rx
+        if ev.vscp_class != CLASS_VSCP or ev.vscp_type != EVENT_WHO_IS_THERE_RESPONSE:
+            return
+        if len(ev.data) != 8 or ev.data[0] >= 7 or ev.guid.nickname is None:
+            return
+        fragments.setdefault(ev.guid.nickname, dict())[int(ev.data[0])] = ev.data[1:]
+        last_rx = loop.time()
 
-        guid = Guid(bytes([byte for byte in reversed(raw[0:16])]))
-        mdf = raw[16:].split(b'\0')[0].decode()
+    async def probe(nicknames):
+        await vscp.send_many([Event(vscp_class=CLASS_VSCP, vscp_type=EVENT_WHO_IS_THERE,
+                                    head=priority << 5, data=struct.pack('>B', nickname))
+                              for nickname in nicknames])
+        while True:
+            await asyncio.sleep(window)
+            if loop.time() - last_rx >= window:
+                break
 
-    return guid, mdf
+    vscp.add_listener(collect)
+    try:
+        await probe([NICKNAME_ALL])
+        for _ in range(retries):
+            incomplete = sorted(nickname for nickname, frags in fragments.items() if len(frags) < 7)
+            if not incomplete:
+                break
+            await probe(incomplete)
+    finally:
+        vscp.remove_listener(collect)
+
+    return {nickname: _assemble_who_is_there(frags)
+            for nickname, frags in fragments.items() if len(frags) == 7}
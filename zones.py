@@ -0,0 +1,96 @@
+import struct
+
+from .vscp.event import Event
+from .vscp.const import (CLASS_CONTROL, EVENT_CONTROL_TURN_ON, EVENT_CONTROL_TURN_OFF,
+                         EVENT_CHANGE_LEVEL)
+
+# zone or subzone value addressing all zones/subzones
+ALL = 255
+
+
+class ConflictError(Exception):
+    pass
+
+
+def _matches(event, light):
+    """True if a CONTROL event for address event reaches a light at address light"""
+    return all(e == ALL or l == ALL or e == l for e, l in zip(event, light))
+
+
+def _candidates(address, complete):
+    (zone, subzone) = address
+    if zone in complete and zone != ALL:
+        return ((zone, subzone), (zone, ALL))
+    return ((zone, subzone),)
+
+
+def cover(targets, known, complete=()):
+    """Return a small set of event addresses reaching exactly the addresses
+       in targets, without reaching any other address in known.
+
+    Events to all subzones of a zone (subzone 255) are only used for the
+    zones in complete, of which known holds every receiver, and where all
+    lights they reach are targets. Events to all zones are never used, the
+    receivers of other zones are not known. The cover is built greedily,
+    taking the address reaching most of the remaining targets first."""
+    targets = set(targets)
+    known = set(known) | targets
+    groups = dict()
+    for address in targets:
+        for candidate in _candidates(address, complete):
+            if candidate in groups:
+                continue
+            reached = {light for light in known if _matches(candidate, light)}
+            if candidate == address or reached <= targets:
+                groups[candidate] = reached & targets if candidate != address else {address}
+
+    addresses = []
+    remaining = set(targets)
+    while remaining:
+        best = max(sorted(groups), key=lambda candidate: len(groups[candidate] & remaining))
+        addresses.append(best)
+        remaining -= groups.pop(best)
+    return sorted(addresses)
+
+
+def compile_states(states, known, complete=()):
+    """Compile the wanted state of a number of lights into CONTROL events.
+
+    states maps a (zone, subzone) address to (on, level), level is None when
+    the brightness is not changed. known holds the addresses of all lights,
+    complete the zones of which known holds all receivers (see cover()).
+    Events never reach a known light which is not in states. Returns the
+    events to send as one batch: turn off, turn on, then change level."""
+    commands = dict()  # command -> set of addresses
+    for address, (on, level) in states.items():
+        commands.setdefault('on' if on else 'off', set()).add(address)
+        if on and level is not None:
+            commands.setdefault(level, set()).add(address)
+
+    events = []
+    for command, vscp_type in (('off', EVENT_CONTROL_TURN_OFF), ('on', EVENT_CONTROL_TURN_ON)):
+        for (zone, subzone) in cover(commands.pop(command, ()), known, complete):
+            events.append(Event(vscp_class=CLASS_CONTROL, vscp_type=vscp_type,
+                                data=struct.pack('>BBB', 0, zone, subzone)))
+    for level in sorted(commands):
+        for (zone, subzone) in cover(commands[level], known, complete):
+            events.append(Event(vscp_class=CLASS_CONTROL, vscp_type=EVENT_CHANGE_LEVEL,
+                                data=struct.pack('>BBB', level, zone, subzone)))
+    return events
+
+
+def merge_states(lights):
+    """Merge the wanted state per light into a state per address.
+
+    lights is an iterable of (address, on, level) tuples. Lights sharing an
+    address have to agree, a ConflictError is raised otherwise."""
+    states = dict()
+    for address, on, level in lights:
+        state = (on, level if on else None)
+        previous = states.setdefault(address, state)
+        if previous != state:
+            if previous[0] == on and None in (previous[1], state[1]):
+                states[address] = (on, previous[1] if state[1] is None else state[1])
+                continue
+            raise ConflictError('Conflicting states for zone {} subzone {}'.format(*address))
+    return states